@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from ... import models as m
+from ...views.view_purchases import archive_delivery
+
+
+class Command(BaseCommand):
+    help = "Render the spreadsheets and JSON of terminated deliveries into DELIVERY_ARCHIVE_DIR, queue their PDFs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--network", type=int, help="Only archive the deliveries of this network id")
+        parser.add_argument("-d", "--delivery", type=int, help="Only archive this delivery id")
+
+    def handle(self, *args, **options):
+        deliveries = m.Delivery.objects.filter(state=m.Delivery.TERMINATED).select_related("network")
+        if options["network"] is not None:
+            deliveries = deliveries.filter(network_id=options["network"])
+        if options["delivery"] is not None:
+            deliveries = deliveries.filter(id=options["delivery"])
+        total_written = total_queued = 0
+        for dv in deliveries.order_by("id"):
+            written, queued = archive_delivery(dv)
+            if written or queued:
+                print(f" * dv-{dv.id} {dv.name}: {written} files written, {queued} PDFs queued")
+            total_written += written
+            total_queued += queued
+        print(f"{total_written} files written, {total_queued} PDFs queued for `manage.py pdf_worker`")
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum, Value, DecimalField, Subquery
+from django.db.models.functions import Coalesce
+from ... import models as m
+
+
+class Command(BaseCommand):
+    help = "Check that the ordered quantities maintained on products match their purchases, and optionally repair them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-r", "--repair", action="store_true", help="Fix inconsistent products")
+        parser.add_argument("-d", "--delivery", type=int, help="Only check the products of this delivery id")
+
+    def handle(self, *args, **options):
+        products = m.Product.objects.annotate(
+            actual=Coalesce(Sum("purchase__quantity"), Value(0), output_field=DecimalField())
+        )
+        if options["delivery"] is not None:
+            products = products.filter(delivery_id=options["delivery"])
+        n_wrong = 0
+        for pd_id, name, dv_id, ordered, actual in products.values_list(
+            "id", "name", "delivery_id", "ordered_quantity", "actual"
+        ).order_by("id"):
+            if ordered != actual:
+                n_wrong += 1
+                print(f" * pd-{pd_id} {name} in dv-{dv_id}: {ordered} recorded, {actual} ordered")
+                if options["repair"]:
+                    # Recompute in the DB rather than writing `actual`, in case purchases changed meanwhile
+                    m.Product.objects.filter(id=pd_id).update(
+                        ordered_quantity=Coalesce(
+                            Subquery(
+                                m.Purchase.objects.filter(product_id=pd_id).values("product_id")
+                                .annotate(t=Sum("quantity")).values("t")
+                            ),
+                            Value(0), output_field=DecimalField()
+                        )
+                    )
+        if n_wrong and options["repair"]:
+            m.JournalEntry.log(None, "Repaired ordered quantities of %d products", n_wrong)
+        print(f"{n_wrong} inconsistent products" + (", repaired" if n_wrong and options["repair"] else ""))
@@ -12,6 +12,7 @@ from django_apscheduler import util
 from pathlib import Path
 from datetime import datetime
 from ... import models as m
+from ...views.view_purchases import archive_delivery
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,14 @@ def test_every_minute():
         f.write(f"test_every_minute ran at {datetime.now()}\n")
 
 
+@util.close_old_connections
+def archive_terminated_deliveries():
+    """Render terminated deliveries into the archive, so that they're never computed again.
+    Their PDFs are only queued: LaTeX runs in `manage.py pdf_worker`, not in the scheduler."""
+    for dv in m.Delivery.objects.filter(state=m.Delivery.TERMINATED).select_related("network"):
+        archive_delivery(dv)
+
+
 # The `close_old_connections` decorator ensures that database connections, that have become
 # unusable or are obsolete, are closed before and after our job has run.
 @util.close_old_connections
@@ -74,6 +83,36 @@ class Command(BaseCommand):
             )
             logger.info("Added job 'update_bestof'")
 
+        if True:
+            scheduler.add_job(
+                archive_terminated_deliveries,
+                trigger=CronTrigger(day="*", hour="00", minute="20"),  # Every day at 00:20AM
+                id="archive_terminated_deliveries",  # The `id` assigned to each job MUST be unique
+                max_instances=1,
+                replace_existing=True,
+            )
+            logger.info("Added job 'archive_terminated_deliveries'")
+
+        if True:
+            scheduler.add_job(
+                m.PurchaseDeletion.purge,
+                trigger=CronTrigger(day="*", hour="00", minute="30"),  # Every day at 00:30AM
+                id="purge_purchase_deletions",  # The `id` assigned to each job MUST be unique
+                max_instances=1,
+                replace_existing=True,
+            )
+            logger.info("Added job 'purge_purchase_deletions'")
+
+        if True:
+            scheduler.add_job(
+                m.PdfJob.purge,
+                trigger=CronTrigger(day="*", hour="00", minute="40"),  # Every day at 00:40AM
+                id="purge_pdf_jobs",  # The `id` assigned to each job MUST be unique
+                max_instances=1,
+                replace_existing=True,
+            )
+            logger.info("Added job 'purge_pdf_jobs'")
+
         scheduler.add_job(
             delete_old_job_executions,
             trigger=CronTrigger(
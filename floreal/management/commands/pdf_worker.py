@@ -0,0 +1,55 @@
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from ... import models as m
+from ...views.pdf_jobs import run_job
+
+# How long an idle worker waits before checking the queue again, in seconds
+IDLE_SLEEP = 1
+
+
+def work(once):
+    """Render queued jobs one after the other; when `once`, stop as soon as the queue is empty."""
+    try:
+        while True:
+            close_old_connections()
+            job = m.PdfJob.claim()
+            if job is not None:
+                print(f" * Rendering {job.key}")
+                run_job(job)
+            elif once:
+                return
+            else:
+                time.sleep(IDLE_SLEEP)
+    except KeyboardInterrupt:
+        pass
+
+
+class Command(BaseCommand):
+    help = "Render the PDFs queued by web requests, with a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-w", "--workers", type=int, default=settings.PDF_WORKERS,
+                            help="How many PDFs can be rendered simultaneously")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+
+    def handle(self, *args, **options):
+        n_workers = max(options["workers"], 1)
+        if n_workers == 1:
+            work(options["once"])
+            return
+        # Forked processes mustn't share their parent's database connections
+        connections.close_all()
+        processes = [multiprocessing.get_context("fork").Process(target=work, args=(options["once"],))
+                     for _ in range(n_workers)]
+        for p in processes:
+            p.start()
+        try:
+            for p in processes:
+                p.join()
+        except KeyboardInterrupt:
+            for p in processes:
+                p.join()
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('floreal', '0010_alter_bestof_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
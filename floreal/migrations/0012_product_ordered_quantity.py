@@ -0,0 +1,26 @@
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def compute_ordered_quantities(apps, schema_editor):
+    Product = apps.get_model("floreal", "Product")
+    Purchase = apps.get_model("floreal", "Purchase")
+    totals = Purchase.objects.values_list("product_id").annotate(t=Sum("quantity")).order_by()
+    for pd_id, total in totals:
+        Product.objects.filter(id=pd_id).update(ordered_quantity=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('floreal', '0011_delivery_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='ordered_quantity',
+            field=models.DecimalField(decimal_places=3, default=0, editable=False, max_digits=9),
+        ),
+        migrations.RunPython(compute_ordered_quantities, migrations.RunPython.noop),
+    ]
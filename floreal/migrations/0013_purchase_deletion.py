@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('floreal', '0012_product_ordered_quantity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='purchase',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='PurchaseDeletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivery_id', models.IntegerField()),
+                ('product_id', models.IntegerField()),
+                ('user_id', models.IntegerField(null=True)),
+                ('deleted', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['delivery_id', 'deleted'], name='purchase_deletion_since')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+import django.utils.timezone
+import floreal.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('floreal', '0013_purchase_deletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=256, unique=True)),
+                ('token', models.CharField(default=floreal.models._new_token, max_length=32, unique=True)),
+                ('renderer', models.CharField(max_length=32)),
+                ('args', models.JSONField(default=dict)),
+                ('filename', models.CharField(max_length=256)),
+                ('state', models.CharField(choices=[('Q', 'En attente'), ('R', 'En cours'), ('D', 'Terminé'), ('F', 'Échec')], default='Q', max_length=1)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started', models.DateTimeField(default=None, null=True)),
+                ('finished', models.DateTimeField(default=None, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'created'], name='pdf_job_queue')],
+            },
+        ),
+    ]
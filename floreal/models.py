@@ -1,14 +1,18 @@
 #!/usr/bin/python3
+import os
 import re
+import uuid
 from datetime import datetime, timedelta
 from functools import cached_property
 from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from decimal import Decimal
 from time import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q, Sum, F
 from django.db.models.functions import Now, TruncDate
 from django.utils import timezone
@@ -304,10 +308,29 @@ class Delivery(IdentifiedBySlug):
     creation_date = models.DateTimeField(auto_now_add=True)
     freeze_date = models.DateField(null=True, blank=True, default=None)
     distribution_date = models.DateField(null=True, blank=True, default=None)
+    # Incremented whenever the delivery, its products or its purchases change;
+    # used to version cached renderings of the delivery.
+    generation = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
+    def save(self, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # `generation` is only changed by atomic increments, see `bump_generation()`.
+            # Don't overwrite it with the possibly outdated value loaded with `self`.
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != "generation"
+            ]
+        super().save(**kwargs)
+
+    @classmethod
+    def bump_generation(cls, **filters):
+        """Increment the generation of the deliveries matching `filters`,
+        thus invalidating their cached renderings."""
+        cls.objects.filter(**filters).update(generation=F("generation") + 1)
+
     def state_name(self):
         return self.STATE_CHOICES.get(self.state, "Etat Invalide " + self.state)
 
@@ -328,7 +351,8 @@ class Delivery(IdentifiedBySlug):
 
         if len(overdue) > 0:
             overdue.update(
-                state=cls.FROZEN
+                state=cls.FROZEN,
+                generation=F("generation") + 1
             )
             overdue_ids = ", ".join([f"dv-{dv.id}" for dv in overdue])
             JournalEntry.log(None, "Auto-froze overdue deliveries %s", overdue_ids)
@@ -359,6 +383,9 @@ class Product(models.Model):
     description = models.TextField(null=True, blank=True, default=None)
     place = models.PositiveSmallIntegerField(null=True, blank=True, default=True)
     image = models.ImageField(null=True, default=None, blank=True)
+    # Total quantity ordered by all users, maintained by `Purchase.save()` and
+    # the purchase deletion signal handler; `manage.py check_ordered_quantities` repairs it.
+    ordered_quantity = models.DecimalField(decimal_places=3, max_digits=9, default=0, editable=False)
 
     class Meta:
         # Problematic: during delivery modifications, some product names may transiently have a name
@@ -431,6 +458,16 @@ class Product(models.Model):
         self.unit, w = self._normalize_unit(self.unit)
         if w is not None:
             self.unit_weight = w
+        if self.pk is None or force_insert:
+            # New product, possibly copied from another delivery: no purchase yet
+            self.ordered_quantity = 0
+        elif update_fields is None:
+            # `ordered_quantity` is only changed by atomic increments from purchases.
+            # Don't overwrite it with the possibly outdated value loaded with `self`.
+            update_fields = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != "ordered_quantity"
+            ]
         super(Product, self).save(force_insert, force_update, using, update_fields)
 
     @property
@@ -439,8 +476,7 @@ class Product(models.Model):
         if self.quantity_limit is None:
             return None
         else:
-            quantity_ordered = self.purchase_set.aggregate(t=Sum("quantity"))["t"] or 0
-            return self.quantity_limit - quantity_ordered
+            return self.quantity_limit - self.ordered_quantity
 
     @property
     def description_text(self):
@@ -456,8 +492,26 @@ class Purchase(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.DecimalField(decimal_places=3, max_digits=6)
     created = models.DateTimeField(auto_now_add=True)
-    modified = models.DateTimeField(auto_now=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
 
+    # True while a bulk operation does the bookkeeping of purchase signal handlers itself
+    _bulk_bookkeeping = ContextVar("purchase_bulk_bookkeeping", default=False)
+
+    @classmethod
+    @contextmanager
+    def bulk_bookkeeping(cls):
+        """Within this context, saved and deleted purchases don't update products' ordered quantities,
+        deliveries' generations nor deletion tombstones: the caller does it once for many purchases,
+        cf. `penury.apply_purchases()`."""
+        token = cls._bulk_bookkeeping.set(True)
+        try:
+            yield
+        finally:
+            cls._bulk_bookkeeping.reset(token)
+
+    @classmethod
+    def in_bulk_bookkeeping(cls):
+        return cls._bulk_bookkeeping.get()
 
     @property
     def price(self):
@@ -477,6 +531,25 @@ class Purchase(models.Model):
         packages = self.packages
         return self.quantity - packages if packages else self.quantity
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        pc = super().from_db(db, field_names, values)
+        if "quantity" in field_names:
+            # Quantity currently accounted for in `Product.ordered_quantity`
+            pc._saved_quantity = pc.quantity
+        return pc
+
+    def save(self, *args, **kwargs):
+        quantity = Decimal(str(self.quantity))  # Might have been set from a float
+        delta = quantity - getattr(self, "_saved_quantity", 0)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if delta and not self.in_bulk_bookkeeping():
+                Product.objects.filter(id=self.product_id).update(
+                    ordered_quantity=F("ordered_quantity") + delta
+                )
+        self._saved_quantity = quantity
+
     @property
     def max_quantity(self):
         """What's the current max quantity allowed for this order,
@@ -503,7 +576,127 @@ class Purchase(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['user', 'product'], name='unique_purchase'),
         ]
-        
+
+
+class PurchaseDeletion(models.Model):
+    """Tombstone of a deleted purchase, so that clients polling for purchases modified since a given date
+    are told about deletions too. They're only needed for a short while, and regularly purged.
+    Ids aren't foreign keys: tombstones outlive the products and users whose deletion caused them."""
+
+    RETENTION = timedelta(days=2)
+
+    delivery_id = models.IntegerField()
+    product_id = models.IntegerField()
+    user_id = models.IntegerField(null=True)
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['delivery_id', 'deleted'], name='purchase_deletion_since'),
+        ]
+
+    @classmethod
+    def purge(cls):
+        cls.objects.filter(deleted__lt=timezone.now() - cls.RETENTION).delete()
+
+
+def _new_token():
+    return uuid.uuid4().hex
+
+
+class PdfJob(models.Model):
+    """PDF rendering delegated by web requests to the `pdf_worker` processes: LaTeX takes seconds
+    to run, web workers mustn't wait for it. Jobs are identified by a `key` which changes with the
+    rendered content, so that concurrent requests for the same document share a single rendering.
+    Clients follow the job through its `token`, which can't be guessed from other jobs' tokens;
+    jobs requested by a `user` are theirs only, background jobs have none."""
+
+    (QUEUED, RUNNING, DONE, FAILED) = "QRDF"
+    STATE_CHOICES = {
+        QUEUED: "En attente",
+        RUNNING: "En cours",
+        DONE: "Terminé",
+        FAILED: "Échec",
+    }
+    RETENTION = timedelta(days=1)
+    # Running jobs are presumed dead after that; LaTeX is given 3 runs of `latex.LATEX_RUN_TIMEOUT`
+    TIMEOUT = timedelta(minutes=5)
+
+    key = models.CharField(max_length=256, unique=True)
+    token = models.CharField(max_length=32, unique=True, default=_new_token)
+    renderer = models.CharField(max_length=32)
+    args = models.JSONField(default=dict)
+    filename = models.CharField(max_length=256)
+    user = models.ForeignKey(User, null=True, blank=True, default=None, on_delete=models.CASCADE)
+    state = models.CharField(max_length=1, choices=STATE_CHOICES.items(), default=QUEUED)
+    error = models.TextField(blank=True, default="")
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, default=None)
+    finished = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'created'], name='pdf_job_queue'),
+        ]
+
+    @property
+    def path(self):
+        return os.path.join(settings.PDF_JOB_DIR, self.token + ".pdf")
+
+    @classmethod
+    def enqueue(cls, key, renderer, filename, user=None, **args):
+        """Return the job rendering `key` for `user`, creating it if needed. Failed jobs, and those
+        whose file has been purged, are queued again."""
+        if user is not None:
+            key = "%s:u-%d" % (key, user.id)
+        job, created = cls.objects.get_or_create(
+            key=key, defaults={'renderer': renderer, 'args': args, 'filename': filename, 'user': user}
+        )
+        job.requeue()
+        return job
+
+    def requeue(self):
+        """Queue the job again if it failed, or if its file has been purged."""
+        if self.state == self.FAILED or self.state == self.DONE and not os.path.isfile(self.path):
+            # Conditional update: concurrent requests requeue the job only once
+            PdfJob.objects.filter(id=self.id, state=self.state).update(
+                state=self.QUEUED, created=timezone.now(), started=None, finished=None, error=""
+            )
+            self.state = self.QUEUED
+
+    @classmethod
+    def claim(cls):
+        """Pick the oldest queued job and mark it as running, or return None if there's none.
+        Several workers can claim concurrently: an update conditioned on the job still being queued
+        tells which one won it, without any lock."""
+        now = timezone.now()
+        cls.objects.filter(state=cls.RUNNING, started__lt=now - cls.TIMEOUT).update(
+            state=cls.FAILED, finished=now, error="Worker died or timed out"
+        )
+        for job_id in cls.objects.filter(state=cls.QUEUED).order_by("created").values_list("id", flat=True)[:10]:
+            if cls.objects.filter(id=job_id, state=cls.QUEUED).update(state=cls.RUNNING, started=now):
+                return cls.objects.get(id=job_id)
+        return None
+
+    def finish(self, error=None):
+        self.state = self.FAILED if error else self.DONE
+        self.error = error or ""
+        self.finished = timezone.now()
+        self.save(update_fields=["state", "error", "finished"])
+
+    @classmethod
+    def purge(cls):
+        """Forget about old finished jobs, and remove their files."""
+        old_jobs = cls.objects.filter(state__in=(cls.DONE, cls.FAILED), finished__lt=timezone.now() - cls.RETENTION)
+        for job in old_jobs:
+            if os.path.isfile(job.path):
+                os.remove(job.path)
+        old_jobs.delete()
+
+    def __str__(self):
+        return "%s [%s]" % (self.key, self.STATE_CHOICES[self.state])
+
+
 class Bestof(models.Model):
     """
     Attempt to gamify the system: score users according to their absolute and relative cumulated purchases.
@@ -1,110 +1,265 @@
-from floreal import models as m
-
-def allocate(limit, wishes):
-    """ Resources allocation in case of penury: When a list of consumers want
-    some resources, and that resource exists in insufficient quantity to
-    satisfy the total demand, a way must be found to allocate existing resources
-    while minimizing unsatisfaction.
-
-    This heuristic finds a ceiling, a maximal authorized quantity of
-    resources allowed per consumer. Those who asked less than the
-    ceiling will receive what they asked for, others will receive the
-    ceiling quantity. resources are attributed by integral values, so
-    there might be some resources left, although less than 1unit per
-    unsatisfied consumer. The couple of remaining resource units beyond
-    the ceiling are attributed to the consumers who asked for the most
-    resources, i.e. presumably the most unsatisfied ones.
-
-    :param limit: total quantity allocated.
-    :param wishes: quantities wished by each customer (dictionary, arbitrary key types).
-    :return:  quantities allocated to each customer (dictionary, same keys as above).
-    """
-    # TODO Maybe remove those who wish 0?
-    wish_values = list(wishes.values())
-    if sum(wish_values) <= limit:
-        # print "There's enough for everyone!"
-        return wishes
-    unallocated = limit  # resources left to attribute
-    granted = {k: 0 for k in wishes.keys()}  # what consumers have been granted so far
-    n_unsatisfied = len(wishes) - wish_values.count(0)  # nb of consumers still unsatisfied
-    ceiling = 0  # current limit (increases until everything is allocated)
-
-    # first stage: find a ceiling that leaves less than one unit per unsatisfied buyer
-    while unallocated >= n_unsatisfied:
-        lot = unallocated // n_unsatisfied  # We can safely distribute at least this much
-        ceiling += lot
-        # print ("%i units left; allocating %i units to %i unsatisfied people" % (unallocated, lot, n_unsatisfied))
-        for k, wish_k in wishes.items():
-            wish_more_k = wish_k - granted[k]
-            if wish_more_k > 0:  # this consumer isn't satisfied yet, give him some more
-                lot_k = min(wish_more_k, lot)  # don't give more than what he asked for, though.
-                # print ("person %i wishes %i more unit, receives %i"%(i, wish_i, lot_i))
-                granted[k] += lot_k
-                unallocated -= lot_k
-                if granted[k] == wishes[k]:
-                    n_unsatisfied -= 1  # He's satisfied now!
-
-    # 2nd stage: give the remaining units, one by one, to biggest unsatisfied buyers
-    got_leftover = sorted(wishes.keys(), key=lambda k: granted[k]-wishes[k])[0:unallocated]
-    # print ("%i more units to distribute, they will go to %s" % (unallocated, got_leftover))
-    for k in got_leftover:
-        granted[k] += 1
-        unallocated -= 1
-
-    # Some invariant checks
-    if True:
-        assert unallocated == 0
-        assert sum(granted.values()) == limit
-        for k in wishes.keys():
-            assert granted[k] <= wishes[k]
-            assert granted[k] <= ceiling+1
-
-    return granted
-
-
-def set_limit(pd, last_pc=None, reallocate=False):
-    """
-    Use `allocate()` to ensure that product `pd` hasn't been granted in amount larger than `limit`.
-    :param pd: product featuring the quantity limit
-    """
-    # TODO: in case of limitation, first cancel extra users' orders
-    if pd.quantity_limit is None:  # No limit, granted==ordered for everyone
-        return
-
-    purchases = m.Purchase.objects.filter(product=pd)
-    wishes = {pc.user_id: int(pc.quantity) for pc in purchases}
-    formerly_granted = {pc.user_id: int(pc.quantity) for pc in purchases}
-
-    if last_pc is not None:
-        # First limit the last purchase
-        wished = sum(wishes.values())
-        excess = wished - pd.quantity_limit
-        if excess <= 0:
-            return  # No penury
-        elif last_pc.quantity > excess:
-            # Fixing the last purchase is enough to cancel the excess
-            last_pc.quantity -= excess
-            last_pc.save()
-            return
-        else:
-            # The last purchase must be canceled, but that won't be enough
-            del wishes[last_pc.user_id]
-            last_pc.delete()
-            # Then go on to penury re-allocation
-
-    if not reallocate:
-        return
-            
-    # Call the algorithm
-    granted = allocate(int(pd.quantity_limit), wishes)
-
-    # Save changed purchases into DB
-    for pc in purchases:
-        uid = pc.user_id
-        if formerly_granted[uid] != granted[uid]:  # Save some DB accesses
-            pc.quantity = granted[uid]
-            # TODO logging
-            # print("%s %s had their purchase of %s modified: ordered %s, formerly granted %s, now granted %s" %
-            #     pc.user.first_name, pc.user.last_name, pc.product.name, pc.quantity, formerly_granted[uid], pc.quantity
-            # )
-            pc.save(force_update=True)
+import heapq
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.utils import timezone
+
+from floreal import models as m
+
+QUANTITY_SCALE = 1000  # Purchase.quantity has 3 decimal places
+
+
+def scaled_quantity(quantity):
+    """Convert a quantity into an integral number of thousandths."""
+    return int(Decimal(str(quantity or 0)) * QUANTITY_SCALE)
+
+
+def allocate(limit, wishes, quantum=1):
+    """ Resources allocation in case of penury: When a list of consumers want
+    some resources, and that resource exists in insufficient quantity to
+    satisfy the total demand, a way must be found to allocate existing resources
+    while minimizing unsatisfaction.
+
+    This heuristic finds a ceiling, a maximal authorized quantity of
+    resources allowed per consumer. Those who asked less than the
+    ceiling will receive what they asked for, others will receive the
+    ceiling quantity. resources are attributed by multiples of `quantum`, so
+    there might be some resources left, although less than 1 quantum per
+    unsatisfied consumer. The couple of remaining quanta beyond
+    the ceiling are attributed to the consumers who asked for the most
+    resources, i.e. presumably the most unsatisfied ones.
+
+    :param limit: total quantity allocated.
+    :param wishes: quantities wished by each customer (dictionary, arbitrary key types).
+    :param quantum: granularity of the allocation. Everything is an integer: fractional
+      quantities must be scaled beforehand, see `reallocate_delivery()`.
+    :return:  quantities allocated to each customer (dictionary, same keys as above).
+    """
+    # TODO Maybe remove those who wish 0?
+    if sum(wishes.values()) <= limit:
+        # print "There's enough for everyone!"
+        return wishes
+
+    # first stage: find the highest ceiling which can be granted to everyone.
+    # Between two consecutive sorted wishes, raising the ceiling by one unit costs one unit
+    # per consumer wishing more than that, so the right interval is found in a single sweep.
+    sorted_wishes = sorted(wishes.values())
+    n = len(sorted_wishes)
+    allocated_below = 0  # sum of the wishes smaller than the current one
+    for i, wish in enumerate(sorted_wishes):
+        if allocated_below + (n - i) * wish > limit:
+            # Ceiling is below this wish: the n-i remaining consumers share what's left
+            ceiling = (limit - allocated_below) // (n - i) // quantum * quantum
+            break
+        allocated_below += wish
+    granted = {k: wish_k if wish_k < ceiling else ceiling for k, wish_k in wishes.items()}
+    unallocated = limit - sum(granted.values())  # less than one quantum per unsatisfied buyer
+
+    # 2nd stage: give the remaining quanta, one by one, to biggest unsatisfied buyers.
+    # A buyer wishing less than one more quantum only gets what he asked for.
+    unsatisfied = [k for k, wish_k in wishes.items() if wish_k > ceiling]
+    if quantum == 1:  # Every leftover unit goes to a different buyer
+        unsatisfied = heapq.nsmallest(unallocated, unsatisfied, key=lambda k: -wishes[k])
+    else:
+        unsatisfied.sort(key=lambda k: -wishes[k])
+    for k in unsatisfied:
+        lot_k = min(quantum, wishes[k] - ceiling)
+        if lot_k <= unallocated:
+            granted[k] += lot_k
+            unallocated -= lot_k
+
+    # Some invariant checks
+    if True:
+        assert 0 <= unallocated < quantum
+        assert sum(granted.values()) == limit - unallocated
+        for k in wishes.keys():
+            assert granted[k] <= wishes[k]
+            assert granted[k] <= ceiling+quantum
+
+    return granted
+
+
+def simulate(limits, wishes, quantum=1):
+    """
+    Vectorized `allocate()`, computing its outcome for many candidate limits at once
+    without changing anything, typically to let producers preview the effect of a quota.
+
+    :param limits: candidate total quantities allocated.
+    :param wishes: quantities wished by each customer (dictionary, arbitrary key types).
+    :param quantum: granularity of the allocation, as in `allocate()`.
+    :return: a `(keys, ceilings, granted, leftover)` tuple: customers, in the order of the matrices columns;
+      the ceiling for each limit, or -1 when there's enough for everyone; a (limits × customers) matrix of
+      granted quantities, identical to what `allocate()` would return; a boolean matrix of the same shape,
+      telling who received some leftover quanta above the ceiling.
+    """
+    keys = list(wishes.keys())
+    w = np.array(list(wishes.values()), dtype=np.int64)
+    limits = np.asarray(limits, dtype=np.int64)
+    n = len(w)
+
+    # first stage: quantity needed to grant everyone at most `sorted_w[i]` is `thresholds[i]`,
+    # which increases with `i`; a binary search finds the ceiling's interval for each limit.
+    sorted_w = np.sort(w)
+    allocated_below = np.concatenate(([0], np.cumsum(sorted_w)))  # sums of the i smallest wishes
+    thresholds = allocated_below[:-1] + (n - np.arange(n)) * sorted_w
+    i = np.searchsorted(thresholds, limits, side="right")
+    penury = i < n
+    i = np.minimum(i, n - 1)
+    ceilings = np.where(penury, (limits - allocated_below[i]) // np.maximum(n - i, 1) // quantum * quantum, -1)
+    granted = np.where(penury[:, None], np.minimum(w, ceilings[:, None]), w)
+    unallocated = np.where(penury, limits - granted.sum(axis=1), 0)
+
+    # 2nd stage: remaining quanta go to the biggest unsatisfied buyers, in the same order as `allocate()`.
+    # Sweep buyers rather than limits, until no one is unsatisfied anymore.
+    leftover = np.zeros(granted.shape, dtype=bool)
+    for k in np.argsort(-w, kind="stable"):
+        lot = np.minimum(quantum, w[k] - ceilings)
+        lot[~penury] = 0
+        if not (lot > 0).any() or not unallocated.any():
+            break
+        gets_lot = (lot > 0) & (lot <= unallocated)
+        granted[gets_lot, k] += lot[gets_lot]
+        unallocated[gets_lot] -= lot[gets_lot]
+        leftover[:, k] = gets_lot
+
+    return keys, ceilings, granted, leftover
+
+
+def apply_purchases(changes, check_quotas=True):
+    """
+    Apply many purchase changes at once, in a single transaction and a constant number of queries:
+    new purchases are inserted together, modified ones updated together, cancelled ones deleted together.
+
+    Current purchases are read and locked within the transaction: concurrent changes of the same purchases
+    are serialized, and each one starts from the quantities saved by the previous one.
+
+    Bulk operations bypass `Purchase.save()` and signals: products' `ordered_quantity`,
+    deliveries generations and deletion tombstones are updated explicitly.
+
+    :param changes: list of `(pd, user_id, quantity)` tuples: the new `quantity` of a user's purchase
+      of product `pd`. A null quantity cancels the purchase; unchanged quantities are left alone.
+    :param check_quotas: if true, increased purchases of limited products are reduced to as much as
+      the quota still allows. Limited products are locked from the check of their remaining quantities
+      until purchases are saved, so that concurrent buyers can't jointly exceed their quota.
+    :return: the granted quantities, in the same order as `changes`; lower than the requested quantity
+      when a quota was reached.
+    :raise IntegrityError: when a purchase to create has been created concurrently; nothing is saved then.
+    """
+    granted = []
+    created, modified, deleted = [], [], []
+    deltas = {}  # pd.id -> change of ordered quantity
+    now = timezone.now()  # bulk_update() doesn't handle `auto_now` fields
+    with transaction.atomic():
+        if check_quotas:
+            left = {
+                pd_id: limit - ordered
+                for pd_id, limit, ordered in m.Product.objects.select_for_update()
+                .filter(id__in={pd.id for pd, _, q in changes if pd.quantity_limit is not None and q})
+                .order_by("id")  # Concurrent baskets lock products in the same order, and can't deadlock
+                .values_list("id", "quantity_limit", "ordered_quantity")
+            }
+        else:
+            left = {}
+        purchases = {
+            (pc.product_id, pc.user_id): pc
+            for pc in m.Purchase.objects.select_for_update()
+            .filter(product_id__in={pd.id for pd, _, _ in changes}, user_id__in={u_id for _, u_id, _ in changes})
+            .order_by("id")
+        }
+
+        for pd, user_id, quantity in changes:
+            quantity = Decimal(str(quantity))
+            pc = purchases.get((pd.id, user_id))
+            previous = pc.quantity if pc is not None else 0
+            if pd.id in left and quantity > previous:
+                # Whatever `pc` already had is part of the ordered quantity, and remains granted
+                quantity = min(quantity, previous + max(left[pd.id], 0))
+                left[pd.id] -= quantity - previous
+            granted.append(quantity)
+
+            if quantity == previous:
+                continue
+            elif pc is None:
+                created.append(m.Purchase(user_id=user_id, product=pd, quantity=quantity))
+            elif quantity == 0:
+                deleted.append((pc, pd))
+            else:
+                pc.quantity = quantity
+                pc.modified = now
+                modified.append(pc)
+            deltas[pd.id] = deltas.get(pd.id, 0) + quantity - previous
+
+        if created:
+            m.Purchase.objects.bulk_create(created)
+        if modified:
+            m.Purchase.objects.bulk_update(modified, ["quantity", "modified"])
+        if deleted:
+            # Signal handlers' work is replaced by `deltas`, tombstones and a single generation bump
+            with m.Purchase.bulk_bookkeeping():
+                m.Purchase.objects.filter(id__in=[pc.id for pc, _ in deleted]).delete()
+            m.PurchaseDeletion.objects.bulk_create([
+                m.PurchaseDeletion(delivery_id=pd.delivery_id, product_id=pd.id, user_id=pc.user_id)
+                for pc, pd in deleted
+            ])
+        if deltas:
+            m.Product.objects.filter(id__in=deltas).update(ordered_quantity=F("ordered_quantity") + Case(
+                *[When(id=pd_id, then=Value(delta)) for pd_id, delta in deltas.items()],
+                output_field=DecimalField(decimal_places=3, max_digits=9)
+            ))
+            m.Delivery.bump_generation(product__id__in=deltas)
+
+    for pc in created + modified:
+        pc._saved_quantity = pc.quantity
+    return granted
+
+
+def reallocate_delivery(dv, product_ids=None):
+    """
+    Use `allocate()` on every limited product of delivery `dv`, e.g. after quotas have been edited,
+    or only on those among `product_ids` if given.
+    Purchases are all retrieved at once, and the changed ones saved at once, in a single transaction.
+
+    Bulk updates bypass `Purchase.save()` and signals: products' `ordered_quantity` and the delivery
+    generation are updated explicitly.
+
+    :return: a list of `(purchase, formerly_granted_quantity)` pairs for every reduced purchase,
+      the purchases holding their new quantities.
+    """
+    with transaction.atomic():
+        # Lock limited products, so that concurrent purchases wait for reallocation to complete
+        products = m.Product.objects.select_for_update().filter(delivery=dv, quantity_limit__isnull=False)
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        products = {pd.id: pd for pd in products}
+        if not products:
+            return []
+        purchases_by_product = {pd_id: [] for pd_id in products}
+        for pc in m.Purchase.objects.filter(product_id__in=products).order_by("id"):
+            purchases_by_product[pc.product_id].append(pc)
+
+        reduced = []  # (pc, formerly_granted) pairs
+        now = timezone.now()  # bulk_update() doesn't handle `auto_now` fields
+        updated_products = []
+        for pd_id, purchases in purchases_by_product.items():
+            pd = products[pd_id]
+            wishes = {pc.user_id: scaled_quantity(pc.quantity) for pc in purchases}
+            limit = scaled_quantity(pd.quantity_limit)
+            if sum(wishes.values()) <= limit:
+                continue  # No penury
+            granted = allocate(limit, wishes, scaled_quantity(pd.quantum) or QUANTITY_SCALE)
+            for pc in purchases:
+                if granted[pc.user_id] != wishes[pc.user_id]:
+                    pc.product = pd
+                    reduced.append((pc, pc.quantity))
+                    pc.quantity = Decimal(granted[pc.user_id]) / QUANTITY_SCALE
+                    pc.modified = now
+            pd.ordered_quantity = Decimal(sum(granted.values())) / QUANTITY_SCALE
+            updated_products.append(pd)
+
+        if reduced:
+            m.Purchase.objects.bulk_update([pc for pc, _ in reduced], ["quantity", "modified"])
+            m.Product.objects.bulk_update(updated_products, ["ordered_quantity"])
+            m.Delivery.bump_generation(id=dv.id)
+    return reduced
@@ -1,9 +1,94 @@
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models import F, Q, Subquery
 from django.dispatch import receiver
 from .. import models as m
+from ..views.delivery_archive import remove_archive
 import registration.signals
 
 # @receiver(pre_save, sender=registration.signals.user_registered)
 # def user_registered(sender, user, **kwargs):
 #     print("User registered", repr(kwargs))
 #     m.JournalEntry.log(user, "User created")
+
+
+# Keep delivery generations up to date, whichever code path (views, admin, shell...)
+# changes the delivery content. Bulk updates don't send signals, and must bump
+# generations explicitly.
+
+@receiver(post_save, sender=m.Delivery)
+def delivery_changed(sender, instance, created, **kwargs):
+    if not created:
+        m.Delivery.bump_generation(id=instance.id)
+        if instance.state != m.Delivery.TERMINATED:
+            # Unarchived: renderings will be computed from the live tables again
+            remove_archive(instance.id)
+        else:
+            # Archived: cached renderings of the live delivery won't be used anymore
+            remove_archive(instance.id, live=True)
+
+
+@receiver(post_delete, sender=m.Delivery)
+def delivery_deleted(sender, instance, **kwargs):
+    remove_archive(instance.id)
+    remove_archive(instance.id, live=True)
+
+
+@receiver(post_save, sender=m.Product)
+@receiver(post_delete, sender=m.Product)
+def product_changed(sender, instance, **kwargs):
+    m.Delivery.bump_generation(id=instance.delivery_id)
+
+
+@receiver(post_save, sender=m.Purchase)
+@receiver(post_delete, sender=m.Purchase)
+def purchase_changed(sender, instance, **kwargs):
+    if m.Purchase.in_bulk_bookkeeping():
+        return
+    m.Delivery.bump_generation(product__id=instance.product_id)
+
+
+@receiver(post_delete, sender=m.Purchase)
+def purchase_deleted(sender, instance, **kwargs):
+    # Handled here rather than in `Purchase.delete()`, so that cascading deletions are accounted for.
+    # Increments are done by `Purchase.save()`.
+    if m.Purchase.in_bulk_bookkeeping():
+        return
+    quantity = getattr(instance, "_saved_quantity", instance.quantity)
+    m.Product.objects.filter(id=instance.product_id).update(
+        ordered_quantity=F("ordered_quantity") - quantity
+    )
+    # The product isn't loaded: cascading deletions, of a delivery or a user, send a signal per purchase
+    m.PurchaseDeletion.objects.create(
+        delivery_id=Subquery(m.Product.objects.filter(id=instance.product_id).values("delivery_id")),
+        product_id=instance.product_id, user_id=instance.user_id
+    )
+
+
+@receiver(post_save, sender=m.NetworkMembership)
+@receiver(post_delete, sender=m.NetworkMembership)
+def membership_changed(sender, instance, **kwargs):
+    # Users listed in a delivery depend on memberships, at least until it's over.
+    m.Delivery.bump_generation(network_id=instance.network_id, state__lt=m.Delivery.TERMINATED)
+
+
+@receiver(post_save, sender=m.Network)
+@receiver(post_save, sender=m.NetworkSubgroup)
+def network_changed(sender, instance, **kwargs):
+    # Network and subgroup names, as well as network grouping, show up in descriptions.
+    network_id = instance.id if sender is m.Network else instance.network_id
+    m.Delivery.bump_generation(network_id=network_id)
+
+
+@receiver(post_save, sender=m.User)
+@receiver(post_save, sender=m.FlorealUser)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # User names, emails and phones show up in the descriptions of deliveries where they
+    # purchased something, or, until those are over, of their networks' deliveries.
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return  # Logging in doesn't change anything described
+    user_id = instance.id if sender is m.User else instance.user_id
+    deliveries = m.Delivery.objects.filter(
+        Q(product__purchase__user_id=user_id) |
+        Q(network__networkmembership__user_id=user_id, state__lt=m.Delivery.TERMINATED)
+    )
+    m.Delivery.bump_generation(id__in=deliveries.values("id"))
@@ -78,6 +78,8 @@ urlpatterns = [
 
     path('admin/dv-<id:delivery>/purchases', views.edit_delivery_purchases, kwargs={'try_subgroup': True}, name='edit_delivery_purchases'),
     path('admin/dv-<id:delivery>/all_purchases', views.edit_delivery_purchases, kwargs={'try_subgroup': False}, name='edit_delivery_all_purchases'),
+    path('admin/dv-<id:delivery>/purchases.json', views.edit_delivery_purchases_json, kwargs={'try_subgroup': True}, name='edit_delivery_purchases_json'),
+    path('admin/dv-<id:delivery>/all_purchases.json', views.edit_delivery_purchases_json, kwargs={'try_subgroup': False}, name='edit_delivery_all_purchases_json'),
     path('admin/dv-<id:delivery>/edit', views.edit_delivery_products, name='edit_delivery_products'),
 
 
@@ -100,9 +102,11 @@ urlpatterns = [
     path('dv-<id:delivery>.pdf', views.view_purchases_latex_table, name='view_delivery_purchases_latex'),
     path('dv-<id:delivery>-cards.pdf', views.view_purchases_latex_cards, name='view_delivery_purchases_cards'),
     path('dv-<id:delivery>.xlsx', views.view_purchases_xlsx, name='view_delivery_purchases_xlsx'),
+    re_path(r'^pdf-(?P<token>[0-9a-f]{32})$', views.pdf_job, name='pdf_job'),
     path('dv-<id:delivery>/purchases.json', views.view_purchases_json, name='view_delivery_purchases_json'),
     path('dv-<id:delivery>/sg-<id:subgroup>/purchases.json', views.view_purchases_json, name='view_delivery_purchases_json'),
     path('admin/dv-<id:delivery>/products.json', views.delivery_products_json, name='delivery_json'),
+    path('admin/dv-<id:delivery>/quotas.json', views.delivery_quotas_json, name='delivery_quotas_json'),
 
     path('dv-<id:delivery>/delete', views.delete_archived_delivery, name='delete_archived_delivery'),
     path('nw-<id:network>/delete-empty-archives', views.delete_all_archived_deliveries, name='delete_all_archived_deliveries'),
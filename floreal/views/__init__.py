@@ -35,10 +35,10 @@ from .getters import (
     must_be_staff,
     must_be_subgroup_staff,
 )
-from .edit_delivery_purchases import edit_delivery_purchases
+from .edit_delivery_purchases import edit_delivery_purchases, edit_delivery_purchases_json
 from .buy import buy
 from .user_registration import user_register, user_update, user_deactivate
-from .edit_delivery_products import edit_delivery_products, delivery_products_json
+from .edit_delivery_products import edit_delivery_products, delivery_products_json, delivery_quotas_json
 from .view_purchases import (
     view_purchases_html,
     view_purchases_latex_table,
@@ -48,6 +48,7 @@ from .view_purchases import (
     all_deliveries_html,
     all_deliveries_latex,
 )
+from .pdf_jobs import pdf_job
 from .spreadsheet import spreadsheet
 from .candidacies import (
     cancel_candidacy,
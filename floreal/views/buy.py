@@ -2,9 +2,12 @@ from django.template.context_processors import csrf
 from django.shortcuts import redirect, render
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseForbidden
+from django.contrib import messages
+from django.db import IntegrityError
 
 from .. import models as m
-from ..penury import set_limit
+from ..francais import plural
+from ..penury import apply_purchases
 from .getters import get_delivery, must_be_prod_or_staff
 
 
@@ -56,30 +59,27 @@ def _parse_form(request):
         if bits[0] == "pd" and bits[1].isdigit():
             quantities[int(bits[1])] = float(val)
             # TODO check quantum
-    previous_purchases = {
-        pc.product.id: pc
-        for pc in m.Purchase.objects.filter(product__delivery=dv, user=request.user)
-    }
 
-    for pd in dv.product_set.all():
-        ordered = quantities.get(pd.id)
-        if ordered is None:  # Typically because pd was out of order
-            continue
+    # Purchases are compared with the submitted quantities under lock, by `apply_purchases()`
+    changes = [  # (pd, user_id, quantity) tuples
+        (pd, request.user.id, quantities[pd.id])
+        for pd in dv.product_set.all()
+        if pd.id in quantities  # Otherwise, typically because pd was out of order
+    ]
 
-        pc = previous_purchases.get(pd.id)
-   
-        if ordered == 0 and pc is None:  # Still not ordered
-            continue
-        elif pc is None: # New order
-            pc = m.Purchase.objects.create(user=request.user, product=pd, quantity=ordered)
-        elif ordered == pc.quantity:  # Unchanged order
-            continue
-        elif ordered == 0:  # Cancelled order
-            pc.delete()
-        else:  # Modified order
-            pc.quantity = ordered
-            pc.save()
-        set_limit(pd, last_pc=pc)
+    # Save everything at once; limited products, which other buyers might compete for, can be reduced
+    try:
+        granted = apply_purchases(changes)
+    except IntegrityError:  # Same purchase created concurrently, e.g. by a double submission
+        messages.error(request, "Votre commande a été modifiée en même temps ailleurs, elle n'a pas été enregistrée.")
+        return False
+    for (pd, _, ordered), granted_pd in zip(changes, granted):
+        if granted_pd < ordered:
+            messages.warning(
+                request,
+                "%s : il n'en restait pas assez, votre commande a été ramenée de %g à %g %s." %
+                (pd.name, ordered, granted_pd, plural(pd.unit, granted_pd))
+            )
 
     m.JournalEntry.log(request.user, "Modified their purchases for dv-%d", dv.id)
     return True  # true == no error
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+"""
+Terminated deliveries don't change anymore: their descriptions (JSON, spreadsheets, PDFs)
+are rendered once, stored under `settings.DELIVERY_ARCHIVE_DIR`, then served from there.
+
+Files are stored as `dv-<id>/g<generation>-<variant>[-sg-<id>][-eu][-ep].<ext>`: should
+a terminated delivery be modified anyway (through the admin for instance), its generation
+changes and the outdated files are ignored, then removed when new ones are written.
+
+The JSON descriptions of other deliveries, requested over and over by purchase tables, are
+stored the same way under `settings.DELIVERY_DESCRIPTION_CACHE_DIR` ("live" renderings):
+their generation changes with every purchase, and so do their file names.
+"""
+
+import os
+import shutil
+from tempfile import NamedTemporaryFile
+from typing import Optional
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+
+from .. import models as m
+
+
+def archive_dir(dv_id: int, live: bool=False) -> str:
+    root = settings.DELIVERY_DESCRIPTION_CACHE_DIR if live else settings.DELIVERY_ARCHIVE_DIR
+    return os.path.join(root, "dv-%d" % dv_id)
+
+
+def archive_path(dv: m.Delivery, variant: str, extension: str, sg: Optional[m.NetworkSubgroup]=None,
+                 empty_users: bool=False, empty_products: bool=False, live: bool=False) -> str:
+    """Where the rendering of a delivery is archived, for a given variant and set of options.
+    With `live`, the rendering of a delivery which isn't terminated is cached rather than archived:
+    it will be outdated as soon as the delivery's generation changes."""
+    name = "g%d-%s" % (dv.generation, variant)
+    if sg is not None:
+        name += "-sg-%d" % sg.id
+    if empty_users:
+        name += "-eu"
+    if empty_products:
+        name += "-ep"
+    return os.path.join(archive_dir(dv.id, live), name + "." + extension)
+
+
+def write_archive(path: str, content) -> None:
+    """Atomically write `content` in `path`, and remove the files of former generations.
+    `content` is either a string, a file such as a spreadsheet, or an iterator of strings such as streamed JSON."""
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(content, (str, bytes)):
+        content = [content]
+    if hasattr(content, 'read'):
+        with NamedTemporaryFile(dir=directory, prefix=".", delete=False) as f, content:
+            shutil.copyfileobj(content, f)
+        _replace(f.name, path)
+    else:
+        for _ in iter_archive(path, content):
+            pass
+
+
+def iter_archive(path: str, chunks):
+    """Pass streamed `chunks` through, while writing them in `path` as `write_archive()` would.
+    Chunks go to disk as they're produced, so that memory use doesn't grow with the content.
+    Nothing is written unless the stream is consumed to its end, e.g. if the client disconnects."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    f = NamedTemporaryFile(dir=directory, prefix=".", delete=False)
+    try:
+        with f:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf8')
+                f.write(chunk)
+                yield chunk
+    except BaseException:
+        os.remove(f.name)
+        raise
+    _replace(f.name, path)
+
+
+def _replace(tmp_path: str, path: str) -> None:
+    """Move a fully written file in place, then remove the files of former generations."""
+    os.replace(tmp_path, path)
+    directory, name = os.path.split(path)
+    generation = name.split("-", 1)[0] + "-"
+    for other in os.listdir(directory):
+        if not other.startswith((generation, ".")):
+            try:
+                os.remove(os.path.join(directory, other))
+            except FileNotFoundError:
+                pass  # Removed by a concurrent writer
+
+
+def remove_archive(dv_id: int, live: bool=False) -> None:
+    """Forget about the archived renderings of a delivery, e.g. when it's not terminated anymore;
+    with `live`, about its cached renderings."""
+    shutil.rmtree(archive_dir(dv_id, live), ignore_errors=True)
+
+
+def archive_response(path: str, content_type: str, filename: Optional[str]=None) -> HttpResponse:
+    """
+    Serve an archived file. When `settings.DELIVERY_ARCHIVE_URL` is set, the actual file
+    transfer is delegated to nginx through an `X-Accel-Redirect` header; that URL must then
+    be an `internal` location aliased to the archive directory.
+    """
+    accel_url = settings.DELIVERY_ARCHIVE_URL
+    if accel_url:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = accel_url + os.path.relpath(path, settings.DELIVERY_ARCHIVE_DIR)
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    if filename is not None:
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
@@ -24,13 +24,16 @@ from typing import (
 )
 from collections import defaultdict
 from .. import models as m
+from .purchase_matrix import PurchaseMatrix, QUANTITY_SCALE
 from abc import ABC, abstractmethod
 from functools import cached_property
-from django.db.models import QuerySet, Q
+from django.db.models import QuerySet, Q, Sum
 from django.db.models.functions import Lower
 from decimal import Decimal
 from datetime import time, datetime
 
+import numpy as np
+
 T = TypeVar("T")
 
 def img_url(image_field: Optional[m.models.ImageField]):
@@ -41,140 +44,235 @@ def sort_users(user_list):
         return (u.first_name != 'extra', u.last_name.lower(), u.first_name.lower())
     return sorted(user_list, key=key)
 
-class SubgroupPurchase(object):
-    """
-    Total purchase of a given product by users of a given network subgroup.
-    Intentionally matches a subset of models.Purchase's interface.
-    """
 
-    def __init__(
-        self, subgroup: m.NetworkSubgroup, product: m.Product, quantity=Decimal(0)
-    ):
-        self.subgroup_id = subgroup.id
-        self.subgroup = subgroup
-        self.product_id = product.id
-        self.product = product
-        self.quantity = quantity
+class UserValues(NamedTuple):
+    """The subset of `m.User` columns needed to describe deliveries,
+    as retrieved by `values_list()` without hydrating model instances."""
 
-    def add(self, pc: m.Purchase):
-        self.quantity += pc.quantity  # TODO make quantity a decimal, rather
+    id: int
+    first_name: str
+    last_name: str
+    email: str
 
-    @cached_property
-    def out_of_package(self) -> float:
-        if self.product.quantity_per_package is None:
-            return self.quantity
-        else:
-            return self.quantity - self.packages * self.product.quantity_per_package
 
-    @cached_property
-    def packages(self) -> Optional[int]:
-        if self.product.quantity_per_package is None:
-            return None
-        else:
-            return self.quantity // self.product.quantity_per_package
+class ProductValues(NamedTuple):
+    """The subset of `m.Product` columns needed to describe deliveries."""
 
-    @cached_property
-    def weight(self) -> float:
-        return self.product.unit_weight * self.quantity
+    id: int
+    name: str
+    price: Decimal
+    quantity_per_package: Optional[int]
+    unit: str
+    unit_weight: Decimal
 
-    @cached_property
-    def price(self) -> float:
-        return self.product.price * self.quantity
 
+# Lookups retrieving `UserValues` fields from a purchase
+USER_VALUES_LOOKUPS = ("user_id", "user__first_name", "user__last_name", "user__email")
 
-PurchaseType = Union[m.Purchase, SubgroupPurchase]
+
+def _membership_filters(dv: m.Delivery, subgroup: Optional[m.NetworkSubgroup], buyers_only=False, prefix=""):
+    """
+    Filter users who were members of the network / subgroup at delivery freeze date,
+    or who are current members if there's no freeze date.
+    The resulting `Q` objects must be passed to the same `filter()` call, so that they
+    apply to the same membership.
+
+    :param buyers_only: only keep network buyers; otherwise, only filter by subgroup membership.
+    :param prefix: lookup path to the user, e.g. `"user__"` to filter purchases.
+    """
+    nm = prefix + "networkmembership__"
+    args = []
+    if buyers_only:
+        args += [Q(**{nm + "network_id": dv.network_id}), Q(**{nm + "is_buyer": True})]
+    if dv.freeze_date is None:
+        # Keep current member
+        args += [Q(**{nm + "valid_until": None})]
+    else:
+        # Keep users who were members at freeze date
+        valid_datetime = datetime.combine(dv.freeze_date, time(23, 59, 59)).astimezone()
+        args += [
+            (Q(**{nm + "valid_until__gte": valid_datetime}) |
+             Q(**{nm + "valid_until": None})),
+            Q(**{nm + "valid_from__lte": valid_datetime}),
+        ]
+    if subgroup is not None:
+        # subgroup also filters for network
+        args += [Q(**{nm + "subgroup_id": subgroup.id})]
+    return args
+
+
+class MatrixPurchase(NamedTuple):
+    """
+    Purchase of a given product, either by a user or by all users of a subgroup,
+    as read from a `PurchaseMatrix` cell.
+    Intentionally matches a subset of models.Purchase's interface.
+    """
+
+    product: m.Product
+    quantity: Decimal
+    packages: Optional[Decimal]
+    out_of_package: Decimal
+    price: Decimal
+    weight: Decimal
+
+    @property
+    def product_id(self) -> int:
+        return self.product.id
 
 
 class BaseRow(object):
     """Rows can be indexed by user or by subgroup.
-    Their purchases can therefore be of type m.Purchase or NetworkPurchase,
-    but both types share a mostly common interface."""
+    Their values are read from row `index` of a `PurchaseMatrix`."""
 
-    def __init__(self, purchases: List[Optional[PurchaseType]]):
-        self.purchases = purchases
+    def __init__(self, matrix: PurchaseMatrix, index: int):
+        self.matrix = matrix
+        self.index = index
 
-    @cached_property
-    def packages(self) -> int:
-        return sum(
-            pc.packages
-            for pc in self.purchases
-            if pc is not None and pc.product.quantity_per_package is not None
-        )
+    def _out_of_package(self, quantity: int, packages: float, per_package: int) -> int:
+        return quantity - int(packages) * per_package
 
     @cached_property
-    def weight(self) -> float:
-        return sum(pc.weight for pc in self.purchases if pc is not None)
+    def purchases(self) -> List[Optional[MatrixPurchase]]:
+        mx = self.matrix
+        i = self.index
+        return [
+            MatrixPurchase(
+                product=pd,
+                quantity=mx.to_decimal(q, "quantity"),
+                packages=Decimal(mx.cell_packages[i, j]) if mx.packaged[j] else None,
+                out_of_package=mx.to_decimal(
+                    self._out_of_package(q, mx.cell_packages[i, j], mx.per_package[j]), "quantity"
+                ),
+                price=mx.to_decimal(mx.cell_price[i, j], "price"),
+                weight=mx.to_decimal(mx.cell_weight[i, j], "weight"),
+            )
+            if mx.present[i, j]
+            else None
+            for j, (pd, q) in enumerate(zip(mx.products, mx.quantity[i]))
+        ]
 
-    @cached_property
-    def price(self) -> float:
-        return sum(pc.price for pc in self.purchases if pc is not None)
+    @property
+    def packages(self) -> Decimal:
+        return Decimal(self.matrix.row_packages[self.index])
+
+    @property
+    def weight(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.row_weight[self.index], "weight")
+
+    @property
+    def price(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.row_price[self.index], "price")
 
 
 class UserRow(BaseRow):
-    def __init__(self, user: m.User, purchases: List[Optional[m.Purchase]]):
+    def __init__(self, user: m.User, matrix: PurchaseMatrix, index: int):
         self.user_id = user.id
         self.user = user
-        super().__init__(purchases)
+        super().__init__(matrix, index)
+
+    def _out_of_package(self, quantity: int, packages: float, per_package: int) -> int:
+        # Same formula as `m.Purchase.out_of_package`, which API clients already rely upon
+        return quantity - int(packages) * QUANTITY_SCALE if packages else quantity
 
 
 class SubgroupRow(BaseRow):
-    def __init__(
-        self, subgroup: m.NetworkSubgroup, purchases: List[Optional[SubgroupPurchase]]
-    ):
+    def __init__(self, subgroup: m.NetworkSubgroup, matrix: PurchaseMatrix, index: int):
         self.subgroup_id = subgroup.id
         self.subgroup = subgroup
-        super().__init__(purchases)
+        super().__init__(matrix, index)
 
 
 class Column(object):
     """
     All purchases of a given product,
     either each user or each subgroup of a network.
+    Values are read from column `index` of a `PurchaseMatrix`.
     """
 
-    def __init__(self, product: m.Product, purchases: List[Optional[PurchaseType]]):
-
-        assert all(pc.product_id == product.id for pc in purchases if pc is not None)
+    def __init__(self, product: m.Product, matrix: PurchaseMatrix, index: int):
         self.product = product
-        self.purchases = purchases
+        self.matrix = matrix
+        self.index = index
 
-    @cached_property
-    def quantity(self) -> float:
-        return sum(pc.quantity for pc in self.purchases if pc is not None)
+    @property
+    def quantity(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.column_quantity[self.index], "quantity")
 
-    @cached_property
-    def out_of_package(self) -> float:
-        if self.product.quantity_per_package is None:
-            return self.quantity
-        else:
-            return self.quantity - self.packages * self.product.quantity_per_package
+    @property
+    def out_of_package(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.column_out_of_package[self.index], "quantity")
 
-    @cached_property
-    def packages(self) -> Optional[int]:
-        if self.product.quantity_per_package is None:
+    @property
+    def packages(self) -> Optional[Decimal]:
+        if not self.matrix.packaged[self.index]:
             return None
         else:
-            return self.quantity // self.product.quantity_per_package
+            return Decimal(self.matrix.column_packages[self.index])
 
-    @cached_property
-    def weight(self) -> float:
-        return sum(pc.weight for pc in self.purchases if pc is not None)
+    @property
+    def weight(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.column_weight[self.index], "weight")
 
-    @cached_property
-    def price(self) -> float:
-        return sum(pc.price for pc in self.purchases if pc is not None)
+    @property
+    def price(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.column_price[self.index], "price")
 
 
 def _num(n):
     return None if n is None else float(n)
 
 
+def _products_json(mx: PurchaseMatrix):
+    """Products and their totals, common to flat and grouped descriptions."""
+    quantities = mx.column_quantity.tolist()
+    packages = mx.column_packages.tolist()
+    out_of_package = mx.column_out_of_package.tolist()
+    prices = mx.column_price.tolist()
+    weights = mx.column_weight.tolist()
+    packaged = mx.packaged.tolist()
+    return [
+        {
+            "id": pd.id,
+            "name": pd.name,
+            "quantity_per_package": _num(pd.quantity_per_package),
+            "unit_weight": _num(pd.unit_weight),
+            "unit": pd.unit,
+            "price": _num(pd.price),
+            "plurals": {"name": m.plural(pd.name), "unit": m.plural(pd.unit)},
+            "total": {
+                "quantity": mx.to_float(quantities[j], "quantity"),
+                "packages": packages[j] if packaged[j] else None,
+                "out_of_package": mx.to_float(out_of_package[j], "quantity"),
+                "price": mx.to_float(prices[j], "price"),
+                "weight": mx.to_float(weights[j], "weight"),
+            },
+        }
+        for j, pd in enumerate(mx.products)
+    ]
+
+
+def _total_json(mx: PurchaseMatrix):
+    return {
+        "packages": mx.packages,
+        "price": mx.to_float(mx.price, "price"),
+        "weight": mx.to_float(mx.weight, "weight"),
+    }
+
+
 class FlatDeliveryDescription(object):
     """
     Detailed description of the purchases of each member of a network
     for a given delivery. Might be created standalone, or as a part of
     a multi-network delivery description of type `GroupedDeliveryDescription`.
 
+    Quantities and totals are held by a `PurchaseMatrix`, rows and columns
+    are views over it.
+
+    With `values_only`, users and products are retrieved as `UserValues` and
+    `ProductValues` tuples rather than model instances, and users who ordered
+    are fetched together with their purchases. Whatever the delivery size,
+    this takes two queries, or three with `empty_users`.
+
     TODO: we should probbaly just have a function producing some JSON, rather than an intermediate class instance with to_json()
     """
 
@@ -183,21 +281,40 @@ class FlatDeliveryDescription(object):
         dv: m.Delivery,
         subgroup: Optional[m.NetworkSubgroup] = None,
         products: Optional[List[m.Product]] = None,
-        matrix: Optional[Dict[Tuple[int, int], m.Purchase]] = None,
+        matrix: Optional[PurchaseMatrix] = None,
         users: Optional[List[m.User]] = None,
         empty_products=False,
         empty_users=False,
+        values_only=False,
     ):
 
         self.delivery = dv
         self.network = dv.network
         self.subgroup = subgroup
+        self.empty_products = empty_products
+        self.empty_users = empty_users
+
+        # (user_id, product_id, quantity) triples, when retrieved together with users
+        purchases = None
 
         # Remove users who aren't in the selected network / subgroup
         if users is not None:
             self.users = users
         else:
-            if not empty_users:
+            if not empty_users and values_only:
+                # Retrieve users who ordered together with their purchases, in a single query
+                pcs = m.Purchase.objects.filter(product__delivery_id=dv.id)
+                if subgroup is not None:
+                    pcs = pcs.filter(*_membership_filters(dv, subgroup, prefix="user__"))
+                users_by_id = {}
+                purchases = []
+                for pd_id, q, *u in pcs.values_list("product_id", "quantity", *USER_VALUES_LOOKUPS):
+                    purchases.append((u[0], pd_id, q))
+                    if u[0] not in users_by_id:
+                        users_by_id[u[0]] = UserValues._make(u)
+                self.users = users_by_id.values()
+
+            elif not empty_users:
                 # Just look at who actually ordered: freeze dates
                 # may not have been respected by staff, allowing
                 # people who weren't member at freeze date
@@ -207,92 +324,131 @@ class FlatDeliveryDescription(object):
                 ).distinct()
 
                 if subgroup is not None:
-                    # filter users by current subgroup membership.
-                    if dv.freeze_date is None:
-                        self.users = self.users.filter(
-                            # subgroup also filters for network
-                            networkmembership__subgroup_id=subgroup.id,
-                            networkmembership__valid_until=None
-                        ).distinct()
-                    else:
-                        # Only keep users who were subgroup members at delivery freeze date
-                        valid_datetime = datetime.combine(dv.freeze_date, time(23, 59, 59)).astimezone()
-                        self.users = self.users.filter(
-                            # subgroup also filters for network
-                            (Q(networkmembership__valid_until__gte=valid_datetime) |
-                             Q(networkmembership__valid_until=None)),
-                            networkmembership__valid_from__lte=valid_datetime,
-                            networkmembership__subgroup_id=subgroup.id
-                        ).distinct()
+                    # filter users by subgroup membership at freeze date.
+                    self.users = self.users.filter(*_membership_filters(dv, subgroup)).distinct()
 
             else:
                 # Users who haven't purchased are kept:
                 # retrieve them from membership at freeze date,
                 # or current membership if there is no freeze date.
-                args = [
-                    Q(networkmembership__network_id=dv.network_id),
-                    Q(networkmembership__is_buyer=True)
-                ]
-                if dv.freeze_date is None:
-                    # Keep current member
-                    args += [Q(networkmembership__valid_until=None)]
-                else:
-                    # Keep users who were members at freeze date
-                    valid_datetime = datetime.combine(dv.freeze_date, time(23, 59, 59)).astimezone()
-                    args += [
-                        (Q(networkmembership__valid_until__gte=valid_datetime) |
-                         Q(networkmembership__valid_until=None)),
-                        Q(networkmembership__valid_from__lte=valid_datetime)
-                    ]
-                if subgroup is not None:
-                    args += [Q(networkmembership__subgroup_id=subgroup.id)]
-                self.users = m.User.objects.filter(*args)
+                self.users = m.User.objects.filter(*_membership_filters(dv, subgroup, buyers_only=True))
+                if values_only:
+                    self.users = map(UserValues._make, self.users.values_list(*UserValues._fields))
 
             self.users = sort_users(self.users)
 
-        if products:
+        if products is not None:
             self.products = products
-        elif empty_products:
-            self.products = dv.product_set.all().order_by("place")
         else:
-            self.products = (
-                m.Product.objects.filter(purchase__product__delivery__in=[dv])
-                .distinct()
-                .order_by("place")
-            )
+            if empty_products:
+                products = dv.product_set.all().order_by("place")
+            else:
+                products = (
+                    m.Product.objects.filter(purchase__product__delivery__in=[dv])
+                    .distinct()
+                    .order_by("place")
+                )
+            if values_only:
+                self.products = [ProductValues._make(v) for v in products.values_list(*ProductValues._fields)]
+            else:
+                self.products = list(products)
 
-        # matrix: {tuple(user_id, product_id) -> m.Purchase}
         # When called from a GroupedDeliveryDescription, the matrix is pre-computed by the caller
         if matrix is None:
-            matrix = defaultdict(lambda: None)
-            for pc in m.Purchase.objects.filter(product__delivery_id=dv.id).select_related("product"):
-                matrix[(pc.user_id, pc.product_id)] = pc
+            user_index = {u.id: i for i, u in enumerate(self.users)}
+            matrix = PurchaseMatrix.from_purchases(
+                user_index,
+                len(self.users),
+                self.products,
+                purchases if purchases is not None else
+                m.Purchase.objects.filter(product__delivery_id=dv.id).values_list("user_id", "product_id", "quantity"),
+            )
+        self.matrix = matrix
 
         # Reference by rows (user or nested description)
-        self.rows: List[UserRow] = [
-            UserRow(u, [matrix[(u.id, pd.id)] for pd in self.products])
-            for u in self.users
-        ]
+        self.rows: List[UserRow] = [UserRow(u, matrix, i) for i, u in enumerate(self.users)]
 
         # Reference by columns (products)
-        self.columns: List[Column] = [
-            Column(pd, [matrix[(u.id, pd.id)] for u in self.users])
-            for pd in self.products
-        ]
-
-    @cached_property
-    def packages(self) -> int:
-        return sum(c.packages or 0 for c in self.columns)
-
-    @cached_property
-    def weight(self) -> float:
-        return sum(c.weight for c in self.columns)
-
-    @cached_property
-    def price(self) -> int:
-        return sum(c.price for c in self.columns)
-
-    def to_json(self, nested=False):
+        self.columns: List[Column] = [Column(pd, matrix, j) for j, pd in enumerate(self.products)]
+
+    @property
+    def packages(self) -> Decimal:
+        return Decimal(self.matrix.packages)
+
+    @property
+    def weight(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.weight, "weight")
+
+    @property
+    def price(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.price, "price")
+
+    def _purchases_json(self):
+        """Generate purchase rows, one per user."""
+        mx = self.matrix
+        qpp = mx.packaged.tolist()
+        product_ids = [pd.id for pd in self.products]
+        for u, present, quantities, packages, prices, weights in zip(
+            self.users,
+            mx.present.tolist(),
+            mx.quantity.tolist(),
+            mx.cell_packages.tolist(),
+            mx.cell_price.tolist(),
+            mx.cell_weight.tolist(),
+        ):
+            yield [
+                {
+                    "user": u.id,
+                    "product": product_ids[j],
+                    "quantity": mx.to_float(quantities[j], "quantity"),
+                    "packages": packages[j] if qpp[j] else None,
+                    # Same formula as `m.Purchase.out_of_package`
+                    "out_of_package": mx.to_float(
+                        quantities[j] - int(packages[j]) * QUANTITY_SCALE if packages[j] else quantities[j],
+                        "quantity",
+                    ),
+                    "price": mx.to_float(prices[j], "price"),
+                    "weight": mx.to_float(weights[j], "weight"),
+                }
+                if present[j]
+                else None
+                for j in range(len(product_ids))
+            ]
+
+    def _sparse_purchases_json(self):
+        """Generate `[user_index, product_index, quantity]` triples, for purchases only."""
+        mx = self.matrix
+        rows, columns = np.nonzero(mx.present)
+        for i, j, q in zip(rows.tolist(), columns.tolist(), mx.quantity[rows, columns].tolist()):
+            yield [i, j, mx.to_float(q, "quantity")]
+
+    def _users_json(self):
+        mx = self.matrix
+        for u, packages, price, weight in zip(
+            self.users, mx.row_packages.tolist(), mx.row_price.tolist(), mx.row_weight.tolist()
+        ):
+            yield {
+                "id": u.id,
+                "first_name": u.first_name,
+                "last_name": u.last_name,
+                "email": u.email,
+                "total": {
+                    "packages": packages,
+                    "price": mx.to_float(price, "price"),
+                    "weight": mx.to_float(weight, "weight"),
+                },
+            }
+
+    def to_json(self, nested=False, lazy=False, sparse=False):
+        """
+        :param lazy: users and purchases are left as generators, to be consumed
+            by `json_stream.iter_json()` one row at a time.
+        :param sparse: rather than a users × products array of purchase objects,
+            purchases are a list of `[user_index, product_index, quantity]` triples.
+            Prices, weights and packages of purchases are left to the client to compute.
+        """
+        mx = self.matrix
+        purchases = self._sparse_purchases_json() if sparse else self._purchases_json()
         r = {
             "delivery": {
                 "id": self.delivery.id,
@@ -306,72 +462,29 @@ class FlatDeliveryDescription(object):
             "subgroup": None
             if self.subgroup is None
             else {"id": self.subgroup.id, "name": self.subgroup.name},
-            "products": [
-                {
-                    "id": col.product.id,
-                    "name": col.product.name,
-                    "quantity_per_package": _num(col.product.quantity_per_package),
-                    "unit_weight": _num(col.product.unit_weight),
-                    "unit": col.product.unit,
-                    "price": _num(col.product.price),
-                    "plurals": {"name": m.plural(col.product.name), "unit": m.plural(col.product.unit)},
-                    "total": {
-                        "quantity": _num(col.quantity),
-                        "packages": _num(col.packages),
-                        "out_of_package": _num(col.out_of_package),
-                        "price": _num(col.price),
-                        "weight": _num(col.weight),
-                    },
-                }
-                for col in self.columns
-            ],
-            "users": [
-                {
-                    "id": row.user.id,
-                    "first_name": row.user.first_name,
-                    "last_name": row.user.last_name,
-                    "email": row.user.email,
-                    "total": {
-                        "packages": _num(row.packages),
-                        "price": _num(row.price),
-                        "weight": _num(row.weight),
-                    },
-                }
-                for row in self.rows
-            ],
-            "total": {
-                "packages": _num(self.packages),
-                "price": _num(self.price),
-                "weight": _num(self.weight),
-            },
-            "purchases": [
-                [
-                    {
-                        "user": pc.user_id,
-                        "product": pc.product_id,
-                        "quantity": _num(pc.quantity),
-                        "packages": _num(pc.packages)
-                        if pc.packages is not None
-                        else None,
-                        "out_of_package": _num(pc.out_of_package),
-                        "price": _num(pc.price),
-                        "weight": _num(pc.weight),
-                    }
-                    if pc is not None
-                    else None
-                    for pc in row.purchases
-                ]
-                for row in self.rows
-            ],
+            "products": _products_json(mx),
+            "users": self._users_json() if lazy else list(self._users_json()),
+            "total": _total_json(mx),
+            "purchases": purchases if lazy else list(purchases),
         }
         return r
 
 
 # TODO: convert into subgrouped-dd
 class GroupedDeliveryDescription(object):
-    def __init__(self, dv: m.Delivery, empty_products=False, empty_users=False):
+    def __init__(self, dv: m.Delivery, empty_products=False, empty_users=False, values_only=False):
+        """
+        Network-level totals, per subgroup and product, are computed by the database;
+        per-subgroup descriptions, with one row per user, are only built when needed.
+
+        :param values_only: retrieve users and products as `UserValues` and `ProductValues`
+            tuples rather than model instances, cf. `FlatDeliveryDescription`.
+        """
 
         self.delivery = dv
+        self.empty_products = empty_products
+        self.empty_users = empty_users
+        self.values_only = values_only
 
         if empty_products:
             self.products = dv.product_set.all()
@@ -379,95 +492,180 @@ class GroupedDeliveryDescription(object):
             self.products = m.Product.objects.filter(
                 purchase__product__delivery__in=[dv]
             ).distinct()
-        self.products = list(
-            self.products.prefetch_related("purchase_set").order_by("place")
+        self.products = self.products.order_by("place")
+        if values_only:
+            self.products = [ProductValues._make(v) for v in self.products.values_list(*ProductValues._fields)]
+        else:
+            self.products = list(self.products)
+
+        self.subgroups = list(dv.network.networksubgroup_set.all())
+
+        # {subgroup index, product index} -> total quantity, from a single aggregate query.
+        # Purchases of users who left the network or its subgroups are ignored.
+        nm = "user__networkmembership__"
+        totals = (
+            m.Purchase.objects.filter(**{
+                "product__delivery_id": dv.id,
+                nm + "network_id": dv.network_id,
+                nm + "is_buyer": True,
+                nm + "valid_until": None,
+                nm + "subgroup__isnull": False,
+            })
+            .values_list(nm + "subgroup_id", "product_id")
+            .annotate(quantity=Sum("quantity"))
+            .order_by()
+        )
+        self.matrix = PurchaseMatrix.from_totals(
+            {sg.id: i for i, sg in enumerate(self.subgroups)}, len(self.subgroups), self.products, totals
         )
 
-        subgroups = dv.network.networksubgroup_set.all()
-
-        subgroup_users: Dict[int, List[m.User]] = defaultdict(list)  # sgid -> [User*]
-        user_subgroup: Dict[int, int] = {}  # user_id -> subgroup_id
-        for nm in (
-            m.NetworkMembership.objects.filter(network_id=dv.network_id, is_buyer=True, valid_until=None)
-            .select_related("user")
-            .order_by("user__last_name", "user__first_name")
-        ):
-            sg_id = nm.subgroup_id
-            if sg_id is not None:
-                subgroup_users[sg_id].append(nm.user)
-                user_subgroup[nm.user_id] = sg_id
-
-        for (sg_id, user_list) in subgroup_users.items():
-            subgroup_users[sg_id] = sort_users(user_list)
-
-        # {subgroup_id -> {tuple(user_id, product_id) -> purchase}}
-        user_matrices: Dict[
-            int, Dict[Tuple[int, int], Optional[m.Purchase]]
-        ] = defaultdict(lambda: defaultdict(lambda: None))
-
-        # {tuple(subgroup_id, product_id) -> subgroup_purchase}
-        subgroup_matrix: Dict[Tuple[int, int], SubgroupPurchase] = {
-            (sg.id, pd.id): SubgroupPurchase(sg, pd)
-            for sg in subgroups
-            for pd in self.products
-        }
-
-        # {sg_id -> [SubgroupPurchase*]}
-        subgroup_purchases: Dict[int, List[SubgroupPurchase]] = {
-            sg.id: [SubgroupPurchase(sg, pd) for pd in self.products]
-            for sg in subgroups
-        }
-
-        product_index = {pd.id: i for (i, pd) in enumerate(self.products)}
-
-        # Prefetch products, needed to compute purchase prices, weights etc.
-        for pc in m.Purchase.objects.filter(product__delivery_id=dv.id).select_related("product"):
-            sg_id = user_subgroup.get(pc.user_id)
-            pd_id = pc.product_id
-            u_id = pc.user_id
-            if sg_id is None:
-                # print(f"Warning: {pc.user.username} left {dv.network.name}")
-                continue
-            user_matrices[sg_id][(u_id, pd_id)] = pc
-            subgroup_matrix[(sg_id, pd_id)].add(pc)
-            subgroup_purchases[sg_id][product_index[pd_id]].add(pc)
-
-        self.subgroup_descriptions: List[FlatDeliveryDescription] = [
-            FlatDeliveryDescription(
-                dv,
-                subgroup=sg,
-                products=self.products,
-                users=subgroup_users[sg.id],
-                matrix=user_matrices[sg.id],
-                empty_users=empty_users,
-            )
-            for sg in subgroups
-        ]
+        # subgroup index -> description, filled on demand
+        self._subgroup_descriptions: Dict[int, FlatDeliveryDescription] = {}
 
         # Reference by rows (user or nested description)
         self.rows: List[SubgroupRow] = [
-            SubgroupRow(sg, subgroup_purchases[sg.id]) for sg in subgroups
+            SubgroupRow(sg, self.matrix, i) for i, sg in enumerate(self.subgroups)
         ]
 
         # Reference by columns (products)
         self.columns: List[Column] = [
-            Column(pd, [subgroup_matrix[(sg.id, pd.id)] for sg in subgroups])
-            for pd in self.products
+            Column(pd, self.matrix, j) for j, pd in enumerate(self.products)
         ]
 
-    @cached_property
-    def packages(self) -> int:
-        return sum(c.packages or 0 for c in self.columns)
+    def subgroup_description(self, index: int) -> FlatDeliveryDescription:
+        """Description of the `index`-th subgroup, with a row per user; memoized."""
+        if index not in self._subgroup_descriptions:
+            self._describe_subgroups([index])
+        return self._subgroup_descriptions[index]
+
+    @property
+    def subgroup_descriptions(self) -> List[FlatDeliveryDescription]:
+        """Descriptions of every subgroup; those not built yet are built together."""
+        self._describe_subgroups([i for i in range(len(self.subgroups)) if i not in self._subgroup_descriptions])
+        return [self._subgroup_descriptions[i] for i in range(len(self.subgroups))]
+
+    def _describe_subgroups(self, indices: List[int]) -> None:
+        """Build the descriptions of several subgroups with two queries,
+        one for their members and one for their purchases."""
+        if not indices:
+            return
+        dv = self.delivery
+        subgroups = [self.subgroups[i] for i in indices]
+        subgroup_ids = [sg.id for sg in subgroups]
 
-    @cached_property
-    def weight(self) -> float:
-        return sum(c.weight for c in self.columns)
+        subgroup_users: Dict[int, List[m.User]] = defaultdict(list)  # sgid -> [User*]
+        user_subgroup: Dict[int, int] = {}  # user_id -> subgroup_id
+        memberships = (
+            m.NetworkMembership.objects.filter(
+                network_id=dv.network_id, is_buyer=True, valid_until=None, subgroup_id__in=subgroup_ids
+            )
+            .order_by("user__last_name", "user__first_name")
+        )
+        if self.values_only:
+            memberships = (
+                (sg_id, UserValues._make(u))
+                for sg_id, *u in memberships.values_list("subgroup_id", *USER_VALUES_LOOKUPS)
+            )
+        else:
+            memberships = ((nm.subgroup_id, nm.user) for nm in memberships.select_related("user"))
+        for sg_id, u in memberships:
+            subgroup_users[sg_id].append(u)
+            user_subgroup[u.id] = sg_id
+
+        # Users of the subgroups are stacked in a single matrix,
+        # each subgroup spanning a contiguous range of rows.
+        users: List[m.User] = []
+        user_index: Dict[int, int] = {}  # user_id -> row
+        bounds: List[Tuple[int, int]] = []  # subgroup index -> row range
+        for sg in subgroups:
+            start = len(users)
+            for u in sort_users(subgroup_users[sg.id]):
+                if user_subgroup[u.id] == sg.id:
+                    user_index[u.id] = len(users)
+                users.append(u)
+            bounds.append((start, len(users)))
+
+        nm = "user__networkmembership__"
+        purchases = m.Purchase.objects.filter(**{
+            "product__delivery_id": dv.id,
+            nm + "network_id": dv.network_id,
+            nm + "is_buyer": True,
+            nm + "valid_until": None,
+            nm + "subgroup_id__in": subgroup_ids,
+        })
+        user_matrix = PurchaseMatrix.from_purchases(
+            user_index,
+            len(users),
+            self.products,
+            purchases.values_list("user_id", "product_id", "quantity"),
+        )
 
-    @cached_property
-    def price(self) -> int:
-        return sum(c.price for c in self.columns)
+        for i, sg, (start, stop) in zip(indices, subgroups, bounds):
+            self._subgroup_descriptions[i] = FlatDeliveryDescription(
+                dv,
+                subgroup=sg,
+                products=self.products,
+                users=users[start:stop],
+                matrix=user_matrix.take_rows(start, stop),
+                empty_users=self.empty_users,
+            )
 
-    def to_json(self):
+    @property
+    def packages(self) -> Decimal:
+        return Decimal(self.matrix.packages)
+
+    @property
+    def weight(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.weight, "weight")
+
+    @property
+    def price(self) -> Decimal:
+        return self.matrix.to_decimal(self.matrix.price, "price")
+
+    def _purchases_json(self):
+        """Generate purchase rows, one per subgroup."""
+        mx = self.matrix
+        qpp = mx.packaged.tolist()
+        per_package = mx.per_package.tolist()
+        product_ids = [pd.id for pd in self.products]
+        for row, quantities, packages, prices, weights in zip(
+            self.rows,
+            mx.quantity.tolist(),
+            mx.cell_packages.tolist(),
+            mx.cell_price.tolist(),
+            mx.cell_weight.tolist(),
+        ):
+            yield [
+                {
+                    "product": product_ids[j],
+                    "subgroup": row.subgroup_id,
+                    "quantity": mx.to_float(quantities[j], "quantity"),
+                    "packages": packages[j] if qpp[j] else None,
+                    "out_of_package": mx.to_float(quantities[j] - int(packages[j]) * per_package[j], "quantity"),
+                    "price": mx.to_float(prices[j], "price"),
+                    "weight": mx.to_float(weights[j], "weight"),
+                }
+                if quantities[j] > 0
+                else None
+                for j in range(len(product_ids))
+            ]
+
+    def _sparse_purchases_json(self):
+        """Generate `[subgroup_index, product_index, quantity]` triples, for ordered quantities only."""
+        mx = self.matrix
+        rows, columns = np.nonzero(mx.quantity > 0)
+        for i, j, q in zip(rows.tolist(), columns.tolist(), mx.quantity[rows, columns].tolist()):
+            yield [i, j, mx.to_float(q, "quantity")]
+
+    def to_json(self, lazy=False, sparse=False):
+        """
+        :param lazy: subgroups and purchases are left as generators, cf. `FlatDeliveryDescription.to_json()`.
+            Only one subgroup description is then serialized at a time.
+        :param sparse: purchases, of subgroups as well as of their users, are lists of
+            `[row_index, product_index, quantity]` triples, cf. `FlatDeliveryDescription.to_json()`.
+        """
+        subgroups = (sgd.to_json(lazy=lazy, sparse=sparse) for sgd in self.subgroup_descriptions)
+        purchases = self._sparse_purchases_json() if sparse else self._purchases_json()
         return {
             "delivery": {
                 "id": self.delivery.id,
@@ -481,51 +679,10 @@ class GroupedDeliveryDescription(object):
                 "id": self.delivery.network.id,
                 "name": self.delivery.network.name,
             },
-            "products": [
-                {
-                    "id": col.product.id,
-                    "name": col.product.name,
-                    "quantity_per_package": _num(col.product.quantity_per_package),
-                    "unit_weight": _num(col.product.unit_weight),
-                    "unit": col.product.unit,
-                    "price": _num(col.product.price),
-                    "plurals": {"name": m.plural(col.product.name), "unit": m.plural(col.product.unit)},
-                    "total": {
-                        "quantity": _num(col.quantity),
-                        "packages": _num(col.packages),
-                        "out_of_package": _num(col.out_of_package),
-                        "price": _num(col.price),
-                        "weight": _num(col.weight),
-                    },
-                }
-                for col in self.columns
-            ],
-            "subgroups": [
-                self.subgroup_descriptions[i].to_json()
-                for i, row in enumerate(self.rows)
-            ],
-            "total": {
-                "packages": _num(self.packages),
-                "price": _num(self.price),
-                "weight": _num(self.weight),
-            },
-            "purchases": [
-                [
-                    {
-                        "product": pc.product_id,
-                        "subgroup": row.subgroup_id,
-                        "quantity": _num(pc.quantity),
-                        "packages": _num(pc.packages),
-                        "out_of_package": _num(pc.out_of_package),
-                        "price": _num(pc.price),
-                        "weight": _num(pc.weight),
-                    }
-                    if pc.quantity > 0
-                    else None
-                    for pc in row.purchases
-                ]
-                for row in self.rows
-            ],
+            "products": _products_json(self.matrix),
+            "subgroups": subgroups if lazy else list(subgroups),
+            "total": _total_json(self.matrix),
+            "purchases": purchases if lazy else list(purchases),
         }
 
 
@@ -541,12 +698,12 @@ class UserDeliveryDescription(object):
             pc.product_id: pc
             for pc in m.Purchase.objects.filter(product__delivery=dv, user=u).order_by(
                 "product__place"
-            )
+            ).select_related("product")
         }
 
         if empty_products:
             # All products
-            self.products = dv.product_set.all().order_by("place")
+            self.products = list(dv.product_set.all().order_by("place"))
         else:
             # Only products with a purchase by this user
             self.products = [pc.product for pc in purchases_by_pd_id.values()]
@@ -555,8 +712,6 @@ class UserDeliveryDescription(object):
         self.price = sum(pc.price for pc in purchases_by_pd_id.values())
         self.weight = sum(pc.weight for pc in purchases_by_pd_id.values())
 
-        # TODO Check SQL logs, probably a lack of select_related on purchase->product
-
     def to_json(self):
         return {
             "user": {
@@ -606,8 +761,8 @@ class UserDeliveryDescription(object):
                         "weight": _num(pc.weight),
                         # I'm allowed at least whatever I've already bought,
                         # and which is already taken into account by pd.left.
-                        "max_quantity": _num(pd.left + pc.quantity)
-                        if pd.left is not None
+                        "max_quantity": _num(left + pc.quantity)
+                        if (left := pd.left) is not None
                         else None,
                     } if pc is not None else {
                         "id": None,
@@ -15,8 +15,10 @@ from PIL import Image
 
 from .getters import get_delivery, must_be_staff, must_be_prod_or_staff
 from .. import models as m
-from ..penury import set_limit
-from django.http import JsonResponse
+from ..penury import reallocate_delivery, simulate, scaled_quantity, QUANTITY_SCALE
+from django.http import JsonResponse, HttpResponseBadRequest
+from decimal import Decimal
+import numpy as np
 
 
 IMAGE_SIZE = 250
@@ -80,6 +82,60 @@ def delivery_products_json(request, delivery):
     })
 
 
+MAX_SIMULATED_LIMITS = 1000  # per product
+
+
+def delivery_quotas_json(request, delivery):
+    """
+    Preview the outcome of candidate quotas, without changing any purchase.
+    Candidates are passed as `?pd-<id>=<limit>,<limit>...`, one parameter per product.
+    For each limit, tell what every buyer would be granted, who would be unsatisfied,
+    what the ceiling would be (null when there's enough for everyone), and who would
+    receive leftovers above that ceiling.
+    """
+    dv = get_delivery(delivery)
+    must_be_prod_or_staff(request, dv.network)
+
+    try:
+        candidates = {
+            int(k[3:]): [Decimal(x) for x in v.split(",") if x.strip()][:MAX_SIMULATED_LIMITS]
+            for k, v in request.GET.items() if k.startswith("pd-")
+        }
+    except (ValueError, ArithmeticError):
+        return HttpResponseBadRequest("Quotas invalides")
+    if any(x < 0 for limits in candidates.values() for x in limits):
+        return HttpResponseBadRequest("Les quotas ne peuvent pas être négatifs")
+    products = dv.product_set.filter(id__in=candidates)
+    wishes = {pd.id: {} for pd in products}
+    for pd_id, u_id, q in m.Purchase.objects.filter(product__in=products).values_list("product_id", "user_id", "quantity"):
+        wishes[pd_id][u_id] = scaled_quantity(q)
+
+    def to_float(a):
+        return (np.asarray(a) / QUANTITY_SCALE).tolist()
+
+    result = {}
+    for pd in products:
+        limits = [scaled_quantity(x) for x in candidates[pd.id]]
+        keys, ceilings, granted, leftover = simulate(limits, wishes[pd.id], scaled_quantity(pd.quantum) or QUANTITY_SCALE)
+        w = np.array(list(wishes[pd.id].values()), dtype=np.int64)
+        result[pd.id] = {
+            "buyers": keys,
+            "wishes": to_float(w),
+            "simulations": [{
+                "limit": to_float(limits[r]),
+                "ceiling": to_float(ceilings[r]) if ceilings[r] >= 0 else None,
+                "granted": to_float(granted[r]),
+                "unsatisfied": [keys[k] for k in np.flatnonzero(granted[r] < w)],
+                "leftover": [keys[k] for k in np.flatnonzero(leftover[r])],
+            } for r in range(len(limits))]
+        }
+    buyers = m.User.objects.filter(purchase__product__in=products).distinct()
+    return JsonResponse({
+        "products": result,
+        "users": {u.id: u.first_name + " " + u.last_name for u in buyers}
+    })
+
+
 def edit_delivery_products(request, delivery):
     """Edit a delivery (name, state, producer, products). Network staff only."""
 
@@ -255,5 +311,9 @@ def _parse_form(request, is_staff):
             pd.save()
 
     # In case of change in quantity limitations, adjust granted quantities for purchases
-    for pd in dv.product_set.all():
-        set_limit(pd)
+    reduced = reallocate_delivery(dv)
+    if reduced:
+        details = ", ".join(f"u-{pc.user_id} pd-{pc.product_id} {former}→{pc.quantity}" for pc, former in reduced)
+        if len(details) > 900:  # Journal entries are limited to 1024 chars
+            details = details[:900] + "..."
+        m.JournalEntry.log(request.user, "Reduced %d purchases to fit quotas in dv-%d: %s", len(reduced), dv.id, details)
@@ -1,15 +1,21 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import json
 import re
+from decimal import Decimal
 
 import django
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
 from django.template.context_processors import csrf
 from django.shortcuts import redirect, render
 from django.core.exceptions import PermissionDenied
+from django.contrib import messages
 
 from .. import models as m
-from ..penury import set_limit
+from ..penury import apply_purchases, reallocate_delivery
 from .getters import get_network, get_delivery, must_be_prod_or_staff
 
 def get_subgroup(u_id, nw_id):
@@ -21,13 +27,13 @@ def get_subgroup(u_id, nw_id):
     ).first()
 
 
-def edit_delivery_purchases(request, delivery, try_subgroup: bool):
+def _get_editor_subgroup(request, dv, try_subgroup: bool):
     """
-    Allows to change the user purchases for a given delivery.
-    Access to either every user or a single subgroup depending on requester's status.
+    Check that the requesting user can edit the purchases of delivery `dv`.
+    :return: the subgroup whose purchases are edited (None to edit every subgroup),
+      and whether the user is network staff.
     """
     user = request.user
-    dv = get_delivery(delivery)
     if dv.state not in (m.Delivery.PREPARATION, m.Delivery.ORDERING_ALL, m.Delivery.ORDERING_ADMIN):
         raise PermissionDenied("Delivery is not editable")
     try:
@@ -42,6 +48,32 @@ def edit_delivery_purchases(request, delivery, try_subgroup: bool):
         sg = get_subgroup(user.id, dv.network_id)
         if sg is None:
             raise
+    return sg, is_staff
+
+
+def _authorized_users(dv, sg):
+    """Ids of the users whose purchases can be edited: members of that network / subgroup."""
+    if sg:
+        assert sg.network_id == dv.network_id
+        return set(m.User.objects.filter(
+            networkmembership__valid_until=None,
+            networkmembership__subgroup_id=sg.id,
+        ).values_list("id", flat=True))
+    else:
+        return set(m.User.objects.filter(
+            networkmembership__valid_until=None,
+            networkmembership__network_id=dv.network_id,
+        ).values_list("id", flat=True))
+
+
+def edit_delivery_purchases(request, delivery, try_subgroup: bool):
+    """
+    Allows to change the user purchases for a given delivery.
+    Access to either every user or a single subgroup depending on requester's status.
+    """
+    user = request.user
+    dv = get_delivery(delivery)
+    sg, is_staff = _get_editor_subgroup(request, dv, try_subgroup)
 
     if request.method == 'POST':
         _parse_form(request, dv, sg)
@@ -80,40 +112,151 @@ def _parse_form(request, dv, sg):
 
     # Check that every user is in that network / subgroup
     user_ids = {u_id for (_, u_id, _) in mods}
-    if sg:
-        assert sg.network_id == dv.network_id
-        authorized_users = {u.id for u in m.User.objects.filter(
-            networkmembership__valid_until=None,
-            networkmembership__subgroup_id=sg.id,
-        )}
-    else:
-        authorized_users = {u.id for u in m.User.objects.filter(
-            networkmembership__valid_until=None,
-            networkmembership__network_id=dv.network_id,
-        )}
-
-    assert user_ids.issubset(authorized_users)
-
-    check_quotas = set()  # Products which might have gone over quota
-
-    for pd_id, u_id, q in mods:
-        pc = m.Purchase.objects.filter(product_id=pd_id, user_id=u_id).first()
-        if pc is None:  # Create purchase
-            pd = m.Product.objects.get(id=pd_id)
-            assert dv.id == pd.delivery_id
-            m.Purchase.objects.create(product_id=pd_id, user_id=u_id, quantity=q)
-            check_quotas.add(pd)
-        elif q == 0.:  # Delete purchase
-            assert pc.product.delivery_id == dv.id
-            pc.delete()
-        else:  # Modify existing purchase
-            assert pc.product.delivery_id == dv.id
-            pc.quantity = q
-            pc.save()
-            check_quotas.add(pc.product)
-
-    if check_quotas:
-        for pd in check_quotas:
-            set_limit(pd)
+    assert user_ids.issubset(_authorized_users(dv, sg))
+
+    # Submitted cells are compared with current purchases under lock, by `apply_purchases()`
+    products = {pd.id: pd for pd in dv.product_set.all()}
+    assert all(pd_id in products for (pd_id, _, _) in mods)
+    changes = [(products[pd_id], u_id, q) for pd_id, u_id, q in mods]  # (pd, user_id, quantity) tuples
+
+    # Staff can exceed quotas: once everything is saved, reallocate the limited products
+    try:
+        with transaction.atomic():
+            apply_purchases(changes, check_quotas=False)
+            if any(pd.quantity_limit is not None for pd, _, _ in changes):
+                reduced = reallocate_delivery(dv)
+                if reduced:
+                    m.JournalEntry.log(request.user, "Reduced %d purchases to fit quotas in dv-%d", len(reduced), dv.id)
+    except IntegrityError:  # A purchase was created concurrently: nothing was saved
+        messages.error(request, "Des achats ont été modifiés en même temps ailleurs, rien n'a été enregistré.")
+        return
 
     m.JournalEntry.log(request.user, "Modified user purchases in dv-%d", dv.id)
+
+
+def _version(pc):
+    """Purchases are versioned by their modification date; missing purchases by None."""
+    return pc.modified.isoformat() if pc is not None else None
+
+
+def _totals(dv, user_ids, products, modified_users, modified_products):
+    """Totals of the edited purchases grid, for the rows and columns of the modified cells."""
+    columns = {pd.id: Decimal(0) for pd in products.values()}
+    for pd_id, q in (
+        m.Purchase.objects.filter(product__delivery=dv, user_id__in=user_ids)
+        .values_list("product_id").annotate(Sum("quantity"))
+    ):
+        columns[pd_id] = q
+    rows = {u_id: Decimal(0) for u_id in modified_users}
+    for u_id, pd_id, q in m.Purchase.objects.filter(product__delivery=dv, user_id__in=modified_users).values_list(
+        "user_id", "product_id", "quantity"
+    ):
+        rows[u_id] += q * products[pd_id].price
+
+    def column(pd):
+        q = columns[pd.id]
+        result = {"quantity": float(q), "price": float(q * pd.price)}
+        if pd.quantity_per_package:
+            packages = q // pd.quantity_per_package
+            result.update(packages=float(packages), out_of_package=float(q - packages * pd.quantity_per_package))
+        return result
+
+    return {
+        "rows": {u_id: {"price": float(price)} for u_id, price in rows.items()},
+        "columns": {pd_id: column(products[pd_id]) for pd_id in modified_products},
+        "total": {"price": float(sum(q * products[pd_id].price for pd_id, q in columns.items()))},
+    }
+
+
+def edit_delivery_purchases_json(request, delivery, try_subgroup: bool):
+    """
+    Edit individual purchases without submitting the whole grid.
+
+    GET returns the version of every editable purchase, as a `{"<product id>-<user id>": version}` dict.
+    PATCH takes a `{"changes": [{"product": id, "user": id, "quantity": q, "expected_modified": version}]}`
+    object, where `version` is the purchase version known to the client, null if it knew of no purchase.
+    Cells changed by someone else in the meantime aren't applied, but reported as conflicts along with
+    their current quantity and version. Return the cells actually modified, including those reduced by
+    quota reallocations, the conflicts, and up-to-date totals for the impacted rows and columns.
+    """
+    dv = get_delivery(delivery)
+    sg, _ = _get_editor_subgroup(request, dv, try_subgroup)
+    user_ids = _authorized_users(dv, sg)
+
+    if request.method == "GET":
+        return JsonResponse({"versions": {
+            f"{pc.product_id}-{pc.user_id}": _version(pc)
+            for pc in m.Purchase.objects.filter(product__delivery=dv, user_id__in=user_ids)
+        }})
+    elif request.method != "PATCH":
+        return HttpResponseNotAllowed(["GET", "PATCH"])
+
+    try:
+        cells = [
+            (int(c["product"]), int(c["user"]), Decimal(str(c["quantity"])), c.get("expected_modified"))
+            for c in json.loads(request.body)["changes"]
+        ]
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        return HttpResponseBadRequest("Modifications invalides")
+    products = {pd.id: pd for pd in dv.product_set.all()}
+    if not all(pd_id in products and u_id in user_ids for pd_id, u_id, _, _ in cells):
+        return HttpResponseForbidden("Produit ou utilisateur invalide")
+
+    conflicts = []
+    try:
+        with transaction.atomic():
+            # Lock edited products, so that concurrent first edits of a cell can't both insert a purchase:
+            # the latter waits, then sees the former's purchase and reports a conflict.
+            list(m.Product.objects.select_for_update().filter(id__in={pd_id for pd_id, _, _, _ in cells})
+                 .order_by("id").values_list("id"))
+            # Lock purchases, so that they don't change between the version check and the update
+            purchases = {
+                (pc.product_id, pc.user_id): pc
+                for pc in m.Purchase.objects.select_for_update().filter(
+                    product__delivery=dv, user_id__in={u_id for _, u_id, _, _ in cells}
+                )
+            }
+            changes = []  # (pd, user_id, quantity) tuples
+            for pd_id, u_id, q, expected in cells:
+                pc = purchases.get((pd_id, u_id))
+                if _version(pc) != expected:
+                    conflicts.append({
+                        "product": pd_id, "user": u_id, "modified": _version(pc),
+                        "quantity": float(pc.quantity) if pc is not None else 0,
+                    })
+                elif q != (pc.quantity if pc is not None else 0):
+                    changes.append((products[pd_id], u_id, q))
+            apply_purchases(changes, check_quotas=False)
+            modified = {(pd.id, u_id) for pd, u_id, _ in changes}  # (product id, user id) cells
+            if limited := {pd.id for pd, _, _ in changes if pd.quantity_limit is not None}:
+                reduced = reallocate_delivery(dv, limited)
+                if reduced:
+                    m.JournalEntry.log(request.user, "Reduced %d purchases to fit quotas in dv-%d", len(reduced), dv.id)
+                    modified.update((pc.product_id, pc.user_id) for pc, _ in reduced if pc.user_id in user_ids)
+    except IntegrityError:
+        # A purchase was inserted meanwhile by a page which doesn't lock products, e.g. a user's own basket:
+        # nothing was saved, every cell is reloaded as a conflict.
+        current = {
+            (pc.product_id, pc.user_id): pc
+            for pc in m.Purchase.objects.filter(product__delivery=dv, user_id__in={u_id for _, u_id, _, _ in cells})
+        }
+        changes, modified = [], set()
+        conflicts = [{
+            "product": pd_id, "user": u_id, "modified": _version(pc := current.get((pd_id, u_id))),
+            "quantity": float(pc.quantity) if pc is not None else 0,
+        } for pd_id, u_id, _, _ in cells]
+
+    if changes:
+        m.JournalEntry.log(request.user, "Modified %d user purchases in dv-%d", len(changes), dv.id)
+    # Retrieve modified cells again, for their versions; created purchases aren't in `changes`
+    current = {
+        (pc.product_id, pc.user_id): pc
+        for pc in m.Purchase.objects.filter(product__delivery=dv, user_id__in={u_id for _, u_id in modified})
+    }
+    result = _totals(dv, user_ids, products, {u_id for _, u_id in modified}, {pd_id for pd_id, _ in modified})
+    result["cells"] = [{
+        "product": pd_id, "user": u_id, "modified": _version(pc := current.get((pd_id, u_id))),
+        "quantity": float(pc.quantity) if pc is not None else 0,
+    } for pd_id, u_id in modified]
+    result["conflicts"] = conflicts
+    return JsonResponse(result)
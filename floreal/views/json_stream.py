@@ -0,0 +1,50 @@
+"""
+Incremental JSON serialization, for responses too large to be built in memory at once.
+"""
+
+import json
+from types import GeneratorType
+from typing import Any, Iterator
+
+CHUNK_SIZE = 64 * 1024  # characters
+
+
+def _iter_json(obj: Any) -> Iterator[str]:
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (k, v) in enumerate(obj.items()):
+            yield (", " if i else "") + json.dumps(k) + ": "
+            yield from _iter_json(v)
+        yield "}"
+    elif isinstance(obj, GeneratorType):
+        yield "["
+        for i, v in enumerate(obj):
+            if i:
+                yield ", "
+            yield from _iter_json(v)
+        yield "]"
+    else:
+        yield json.dumps(obj)
+
+
+def iter_json(obj: Any, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """
+    Yield the JSON serialization of `obj` in chunks of about `chunk_size` characters;
+    their concatenation is the same string as `json.dumps(obj)`.
+
+    Generators are serialized as lists, and are only consumed as the output progresses:
+    producing rows through generators keeps memory usage flat, whatever the number of rows.
+    Dicts are walked recursively, so that they can hold generators; other values,
+    lists included, are serialized in one go.
+    """
+    buffer = []
+    size = 0
+    for s in _iter_json(obj):
+        buffer.append(s)
+        size += len(s)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
@@ -1,73 +1,244 @@
 #!/usr/bin/env python3
 # -*-coding: utf-8 -*-
+import glob
+import hashlib
+import logging
 import os
+import shutil
 import subprocess
-from tempfile import NamedTemporaryFile
+import time
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
+from django.conf import settings
 from django.template.loader import get_template
 from .delivery_description import FlatDeliveryDescription
 
+
+logger = logging.getLogger(__name__)
+
 LATEX_RUN_TIMEOUT = 30  # seconds
+FORMAT_RETENTION = 7 * 24 * 3600  # seconds an unused preamble format is kept
+AUX_RETENTION = 30 * 24 * 3600  # seconds an unused `.aux` file is kept
 
 
 RERUN_LATEX_IF = [
     b"Package longtable Warning: Table widths have changed. Rerun LaTeX."
 ]
 
+# Ends the part of the preamble shared by every document, cf. `common.tex`. Everything before it
+# is precompiled into a LaTeX format, so that pdflatex doesn't load the same packages at every run.
+COMMON_PREAMBLE_END = b"% -- End of common preamble --\n"
 
-def render_latex(template_name, ctx):
+
+def render_latex(template_name, ctx, aux_name=None):
     """Render a TeX source from a template name + context, then runs it through PDF LaTeX
     until it reached a fixpoint (tables tend to need several runs until they find a proper layout).
     Return the PDF content as a binary string.
-    """    
+
+    PDFs are cached according to their TeX source: as long as the rendered document doesn't change,
+    downloading it again only costs a template rendering.
+
+    :param aux_name: identifies successive versions of the same document. The `.aux` file of the
+      last compilation is kept under that name, and given to the next one: table widths computed
+      by longtable are mostly unchanged, and the fixpoint is often reached in a single run.
+    """
     t = get_template(template_name)
     tex_unicode = t.render(ctx)
     tex_string = tex_unicode.encode('utf8')
-    with NamedTemporaryFile(suffix='.tex', delete=False) as f:
-        f.write(tex_string)
-        f.flush()
-        src_file_name = f.name
-        dst_file_name = os.path.splitext(src_file_name)[0]+".pdf"
-        # print("Generated tex file %s" % src_file_name)
-        prev_dir = os.getcwd()
+    digest = hashlib.sha256(template_name.encode('utf8') + b"\0" + tex_string).hexdigest()
+    pdf_string = _cached_pdf(digest)
+    if pdf_string is None:
+        pdf_string = _compile(tex_string, aux_name)
+        _cache_pdf(digest, pdf_string)
+    return pdf_string
+
+
+def _compile(tex_string, aux_name=None):
+    """Compile a TeX source, with its common preamble precompiled if possible."""
+    preamble, marker, body = tex_string.partition(COMMON_PREAMBLE_END)
+    format_name = _preamble_format(preamble) if marker else None
+    if format_name is not None:
         try:
-            os.chdir("/tmp/")
-            cmd = ["pdflatex", "-halt-on-error", src_file_name]
-            # Run Latex up to 3 times, as longtable may need multiple runs to 
-            for i in range(3):
+            return _run_latex(body, format_name, aux_name)
+        except (AssertionError, subprocess.TimeoutExpired, FileNotFoundError):
+            # Failed, timed out or produced no PDF: the format may have been built by another version of TeX,
+            # rebuild it next time and compile this document without it
+            try:
+                os.remove(os.path.join(settings.LATEX_FORMAT_DIR, format_name + ".fmt"))
+            except FileNotFoundError:
+                pass
+    return _run_latex(tex_string, aux_name=aux_name)
+
+
+def _preamble_format(preamble):
+    """Return the name of the LaTeX format where `preamble` is precompiled, building it on first use;
+    None if it can't be built. Formats are named after their content: when `common.tex` changes,
+    a new one is built, and the former ones are eventually removed once they're not used anymore."""
+    name = "common-" + hashlib.sha256(preamble).hexdigest()[:16]
+    path = os.path.join(settings.LATEX_FORMAT_DIR, name + ".fmt")
+    try:
+        os.utime(path)  # Still in use
+        return name
+    except FileNotFoundError:
+        pass  # Never built, or removed by a concurrent worker: (re)build it
+
+    os.makedirs(settings.LATEX_FORMAT_DIR, exist_ok=True)
+    with TemporaryDirectory(dir=settings.LATEX_FORMAT_DIR) as build_dir:
+        with open(os.path.join(build_dir, name + ".tex"), "wb") as f:
+            f.write(preamble + b"\\dump\n")
+        cmd = ["pdflatex", "-ini", "-halt-on-error", "-jobname=" + name, "&pdflatex", name + ".tex"]
+        try:
+            p = subprocess.run(cmd, cwd=build_dir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               timeout=LATEX_RUN_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return None
+        built = os.path.join(build_dir, name + ".fmt")
+        if p.returncode != 0 or not os.path.isfile(built):
+            return None
+        # Atomic: concurrent workers may build the same format
+        os.replace(built, path)
+
+    for other in glob.glob(os.path.join(settings.LATEX_FORMAT_DIR, "common-*.fmt")):
+        try:
+            if other != path and os.path.getmtime(other) < time.time() - FORMAT_RETENTION:
+                os.remove(other)
+        except FileNotFoundError:
+            pass  # Already removed by a concurrent worker
+    return name
+
+
+def _run_latex(tex_string, format_name=None, aux_name=None):
+    """Compile a TeX source into a PDF, in a private directory removed afterwards: neither the
+    process' current directory nor other compilations are affected, so several can run in parallel.
+    With a `format_name`, the source is compiled with that precompiled format, cf. `_preamble_format()`.
+    With an `aux_name`, the `.aux` file is seeded from, then saved to, the `.aux` store."""
+    with TemporaryDirectory(prefix="latex-") as job_dir:
+        src_file_name = os.path.join(job_dir, "document.tex")
+        dst_file_name = os.path.join(job_dir, "document.pdf")
+        aux_file_name = os.path.join(job_dir, "document.aux")
+        with open(src_file_name, "wb") as f:
+            f.write(tex_string)
+        stored_aux = os.path.join(settings.LATEX_AUX_DIR, aux_name + ".aux") if aux_name else None
+        seeded = stored_aux is not None and os.path.isfile(stored_aux)
+        if seeded:
+            shutil.copyfile(stored_aux, aux_file_name)
+
+        cmd = ["pdflatex", "-halt-on-error", "-output-directory=" + job_dir, src_file_name]
+        env = None
+        if format_name is not None:
+            cmd[1:1] = ["-fmt=" + format_name]
+            # Trailing separator: TeX's default formats are still found
+            env = dict(os.environ, TEXFORMATS=settings.LATEX_FORMAT_DIR + os.pathsep)
+        # Run Latex up to 3 times, as longtable may need multiple runs to 
+        for passes in range(1, 4):
+            try:
+                p = subprocess.Popen(cmd, cwd=job_dir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, env=env)
+                output, errors = p.communicate(timeout=LATEX_RUN_TIMEOUT)
+                assert p.returncode == 0, "Impossible de compiler "+(aux_name or "le document")
+
+                if not any(line in output for line in RERUN_LATEX_IF):
+                    break
+            except subprocess.TimeoutExpired:
+                # Avoid resource leaks upon timeout
+                p.kill()
+                p.communicate()
+                raise
+
+        with open(dst_file_name, "rb") as g:
+            pdf_string = g.read()
+        logger.info("pdflatex: %d pass(es) for %s, %s",
+                    passes, aux_name or "a document", "with a previous .aux" if seeded else "from scratch")
+        if stored_aux is not None and os.path.isfile(aux_file_name):
+            _store_aux(aux_file_name, stored_aux)
+    return pdf_string
+
+
+def _store_aux(aux_file_name, stored_aux):
+    """Keep an `.aux` file for the next compilation of the same document, and forget about
+    those which haven't been used for a while."""
+    os.makedirs(settings.LATEX_AUX_DIR, exist_ok=True)
+    with NamedTemporaryFile(dir=settings.LATEX_AUX_DIR, prefix=".", delete=False) as f, \
+         open(aux_file_name, "rb") as g:
+        shutil.copyfileobj(g, f)
+    os.replace(f.name, stored_aux)
+
+    expired = time.time() - AUX_RETENTION
+    with os.scandir(settings.LATEX_AUX_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".aux"):
                 try:
-                    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
-                    output, errors = p.communicate(timeout=LATEX_RUN_TIMEOUT)
-                    assert p.returncode == 0, "Impossible de compiler "+src_file_name
-
-                    if any(line in output for line in RERUN_LATEX_IF):
-                        print("RUN AGAIN")
-                        pass
-                    else:
-                        # print(output.decode('utf8'))
-                        break
-                except subprocess.TimeoutExpired: 
-                    # Avoid resource leaks upon timeout
-                    p.kill()
-                    output, errors = p.communicate()
-
-            with open(dst_file_name, "rb") as g:
-                pdf_string = g.read()
-        finally:
-            os.chdir(prev_dir)
+                    if entry.stat().st_mtime < expired:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass  # Removed by another process meanwhile
+
+
+def _cached_pdf(digest):
+    """Return the cached PDF with this digest, or None."""
+    path = os.path.join(settings.LATEX_CACHE_DIR, digest + ".pdf")
+    try:
+        with open(path, "rb") as f:
+            pdf_string = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)  # Modification dates tell which entries were least recently used
+    except FileNotFoundError:
+        pass  # Evicted by another process meanwhile
     return pdf_string
 
 
+def _cache_pdf(digest, pdf_string):
+    """Store a PDF in the cache, then evict the least recently used ones if it's too big."""
+    os.makedirs(settings.LATEX_CACHE_DIR, exist_ok=True)
+    with NamedTemporaryFile(dir=settings.LATEX_CACHE_DIR, prefix=".", delete=False) as f:
+        f.write(pdf_string)
+    os.replace(f.name, os.path.join(settings.LATEX_CACHE_DIR, digest + ".pdf"))
+
+    entries = []
+    with os.scandir(settings.LATEX_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".pdf"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Evicted by another process meanwhile
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= settings.LATEX_CACHE_SIZE:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Already evicted by another process
+        total_size -= size
+
+
+def _aux_name(template, dd):
+    """Name under which the `.aux` files of a delivery description's renderings are kept."""
+    sg = getattr(dd, "subgroup", None)
+    name = "%s-dv-%d" % (os.path.splitext(template)[0], dd.delivery.id)
+    if sg is not None:
+        name += "-sg-%d" % sg.id
+    # Empty rows and columns change table layouts: such renderings have their own `.aux` files
+    if dd.empty_users:
+        name += "-eu"
+    if dd.empty_products:
+        name += "-ep"
+    return name
+
+
 def table(dd):
     template = "subgroup-table.tex" if isinstance(dd, FlatDeliveryDescription) else "delivery-table.tex"
     orientation = "landscape" if len(dd.products) > 18 else "portrait"
-    return render_latex(template, {'dd': dd, 'orientation': orientation})
+    return render_latex(template, {'dd': dd, 'orientation': orientation}, _aux_name(template, dd))
 
 
 def cards(dd):
-    max_order_size = max((len([pc for pc in row.purchases if pc]) for row in dd.rows), default=0)
+    max_order_size = int(dd.matrix.row_count.max(initial=0))
     template = "subgroup-cards.tex" if isinstance(dd, FlatDeliveryDescription) else "delivery-cards.tex"
-    return render_latex(template, {'dd': dd, 'max_order_size': max_order_size})
+    return render_latex(template, {'dd': dd, 'max_order_size': max_order_size}, _aux_name(template, dd))
 
 
 def emails(nw):
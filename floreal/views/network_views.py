@@ -1,6 +1,7 @@
 import re
 from collections import defaultdict
 from datetime import datetime
+from time import time
 
 from django.db.models import Q, F, Sum, Max
 from django.http import HttpResponseForbidden, HttpResponseBadRequest
@@ -194,9 +195,11 @@ def set_network_validation(request, network, val):
 def view_emails_pdf(request, network):
     nw = get_network(network)
     must_be_staff(request, nw)
-    from . import latex
+    from .pdf_jobs import enqueue_pdf
 
-    return latex.emails(nw)
+    # Memberships aren't versioned: renderings are only shared within the same minute
+    key = "emails:nw-%d:%d" % (nw.id, time() // 60)
+    return enqueue_pdf(request, key, 'emails', nw.name + " emails", network=nw.id)
 
 
 def view_emails(request, network):
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+"""
+LaTeX renderings are too slow to run while holding a web worker: PDF requests only enqueue
+a `PdfJob`, then redirect to a page which waits for `manage.py pdf_worker` to render it.
+
+Renderers are referred to by name in the database; their arguments must be JSON-serializable,
+hence ids rather than model instances.
+"""
+
+import logging
+import os
+from tempfile import NamedTemporaryFile
+
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponseForbidden
+from django.shortcuts import redirect, render
+
+from . import latex
+from .delivery_archive import archive_path, archive_response, write_archive
+from .. import models as m
+
+
+logger = logging.getLogger(__name__)
+
+# How often the waiting page checks whether its PDF is ready, in seconds
+POLL_INTERVAL = 2
+
+
+def _render_delivery(variant, delivery, subgroup=None, empty_users=False, empty_products=False):
+    from .view_purchases import RENDERERS, describe
+    dv = m.Delivery.objects.select_related("network").get(id=delivery)
+    sg = m.NetworkSubgroup.objects.get(id=subgroup) if subgroup is not None else None
+    renderer, extension = RENDERERS[variant]
+    content = renderer(describe(dv, sg, empty_products, empty_users))
+    if dv.state == m.Delivery.TERMINATED:
+        # Served from the archive from now on, cf. `view_purchases.render_description()`
+        write_archive(archive_path(dv, variant, extension, sg, empty_users, empty_products), content)
+    return content
+
+
+def _render_all_deliveries(network, states):
+    from .view_purchases import all_deliveries_context
+    return latex.render_latex("all_deliveries.tex", all_deliveries_context(m.Network.objects.get(id=network), states),
+                              aux_name="all_deliveries-nw-%d-%s" % (network, states))
+
+
+def _render_emails(network):
+    return latex.emails(m.Network.objects.get(id=network))
+
+
+# Renderer name in `PdfJob.renderer` -> function returning the PDF content
+JOB_RENDERERS = {
+    'delivery': _render_delivery,
+    'all_deliveries': _render_all_deliveries,
+    'emails': _render_emails,
+}
+
+
+def enqueue_pdf(request, key, renderer, name_stem, **args):
+    """Have a PDF rendered in the background, and redirect to the page where it will be served.
+    Permissions must have been checked beforehand: the job is shared by the user's requests with the same `key`."""
+    filename = (name_stem + ".pdf").replace(" ", "_")
+    job = m.PdfJob.enqueue(key, renderer, filename, request.user, **args)
+    return redirect("pdf_job", token=job.token)
+
+
+def run_job(job):
+    """Render a claimed job, and record its outcome."""
+    try:
+        content = JOB_RENDERERS[job.renderer](**job.args)
+        os.makedirs(os.path.dirname(job.path), exist_ok=True)
+        with NamedTemporaryFile(dir=os.path.dirname(job.path), prefix=".", delete=False) as f:
+            f.write(content)
+        os.replace(f.name, job.path)
+    except Exception as e:
+        logger.exception("PDF job %s failed", job.key)
+        job.finish(error="%s: %s" % (type(e).__name__, e))
+    else:
+        job.finish()
+
+
+@login_required
+def pdf_job(request, token):
+    """Serve the PDF rendered by a job once it's done; until then, a page which reloads itself.
+    Only the user who requested the PDF, whose permissions have been checked then, can follow the job."""
+    job = m.PdfJob.objects.filter(token=token).first()
+    if job is None:
+        raise Http404("Pas de PDF en préparation à cette adresse")
+    if job.user_id != request.user.id:
+        return HttpResponseForbidden("Ce PDF a été demandé par quelqu'un d'autre.")
+    if job.state == m.PdfJob.DONE and os.path.isfile(job.path):
+        return archive_response(job.path, "application/pdf", job.filename)
+    if job.state == m.PdfJob.DONE or 'retry' in request.GET:
+        # File purged, or failure the user wants to retry
+        job.requeue()
+    failed = job.state == m.PdfJob.FAILED
+    response = render(request, "pdf_job.html", {
+        'job': job,
+        'failed': failed,
+        'poll_interval': POLL_INTERVAL,
+    }, status=500 if failed else 202)
+    if not failed:
+        response['Retry-After'] = str(POLL_INTERVAL)
+    return response
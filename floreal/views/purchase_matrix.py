@@ -0,0 +1,216 @@
+"""
+Array-backed storage of the purchases of a delivery.
+
+Quantities are kept in a dense (rows × products) NumPy matrix, rows being
+either users or subgroups, along with per-product price, weight and package
+vectors. Every total (per row, per product, overall) is then a vectorized
+reduction rather than a Python-level sum over model instances.
+
+Decimal DB values are stored as scaled integers, so that totals are exact
+and convert to the same floats / Decimals as the former Decimal sums did.
+"""
+
+from decimal import Decimal
+from functools import cached_property
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .. import models as m
+
+# Scales matching the `decimal_places` of the corresponding model fields
+QUANTITY_SCALE = 1000  # Purchase.quantity
+PRICE_SCALE = 100  # Product.price
+WEIGHT_SCALE = 1000  # Product.unit_weight
+
+
+def _scaled(d, scale: int) -> int:
+    if d is None:
+        return 0
+    elif not isinstance(d, Decimal):
+        d = Decimal(str(d))
+    return int(d * scale)
+
+
+def _decimal(n, scale: int) -> Decimal:
+    """Convert a scaled integer back into an exact Decimal."""
+    return Decimal(int(n)) / scale
+
+
+def _float(n, scale: int) -> float:
+    """Convert a scaled integer into the float closest to its exact value,
+    i.e. the same float as `float(_decimal(n, scale))`."""
+    return int(n) / scale
+
+
+class PurchaseMatrix(object):
+    """
+    Quantities purchased, indexed by (row, product) positions.
+
+    :param products: ordered list of products, i.e. columns
+    :param quantity: int64 matrix of quantities, in `QUANTITY_SCALE` units
+    :param present: boolean matrix, whether each cell holds a purchase
+      (a purchase might have a null quantity, e.g. after a penury reallocation).
+    """
+
+    def __init__(self, products: Sequence[m.Product], quantity: np.ndarray, present: np.ndarray, _vectors=None):
+        self.products = products
+        self.quantity = quantity
+        self.present = present
+        if _vectors is None:
+            qpp = [pd.quantity_per_package or 0 for pd in products]
+            _vectors = (
+                np.array([_scaled(pd.price, PRICE_SCALE) for pd in products], dtype=np.int64),
+                np.array([_scaled(pd.unit_weight, WEIGHT_SCALE) for pd in products], dtype=np.int64),
+                np.array(qpp, dtype=np.int64) * QUANTITY_SCALE,
+            )
+        self._vectors = _vectors
+        self.unit_price, self.unit_weight, self.per_package = _vectors
+        self.packaged = self.per_package > 0
+
+    @classmethod
+    def from_purchases(
+        cls,
+        row_index: Dict[int, int],
+        n_rows: int,
+        products: Sequence[m.Product],
+        purchases: Iterable[Tuple[int, int, Decimal]],
+    ) -> "PurchaseMatrix":
+        """
+        Build a matrix from `(row_key, product_id, quantity)` triples.
+        Purchases whose row key or product isn't indexed are ignored.
+
+        :param row_index: row key (typically a user id) -> row position
+        """
+        product_index = {pd.id: j for j, pd in enumerate(products)}
+        quantity = np.zeros((n_rows, len(products)), dtype=np.int64)
+        present = np.zeros((n_rows, len(products)), dtype=bool)
+        for row_key, pd_id, q in purchases:
+            i = row_index.get(row_key)
+            j = product_index.get(pd_id)
+            if i is None or j is None:
+                continue
+            quantity[i, j] = _scaled(q, QUANTITY_SCALE)
+            present[i, j] = True
+        return cls(products, quantity, present)
+
+    def take_rows(self, start: int, stop: int) -> "PurchaseMatrix":
+        """Sub-matrix of contiguous rows, sharing product vectors."""
+        return PurchaseMatrix(self.products, self.quantity[start:stop], self.present[start:stop], self._vectors)
+
+    @classmethod
+    def from_totals(
+        cls,
+        row_index: Dict[int, int],
+        n_rows: int,
+        products: Sequence[m.Product],
+        totals: Iterable[Tuple[int, int, Decimal]],
+    ) -> "PurchaseMatrix":
+        """
+        Build a matrix from `(row_key, product_id, total_quantity)` triples,
+        typically aggregated by the database, e.g. per subgroup.
+        Cells only hold a purchase if their total isn't null.
+        """
+        mx = cls.from_purchases(row_index, n_rows, products, totals)
+        return cls(products, mx.quantity, mx.quantity != 0, mx._vectors)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.quantity.shape
+
+    # Per-cell values. Price and weight are in (QUANTITY_SCALE * PRICE_SCALE)
+    # and (QUANTITY_SCALE * WEIGHT_SCALE) units respectively.
+
+    @cached_property
+    def cell_price(self) -> np.ndarray:
+        return self.quantity * self.unit_price
+
+    @cached_property
+    def cell_weight(self) -> np.ndarray:
+        return self.quantity * self.unit_weight
+
+    @cached_property
+    def cell_packages(self) -> np.ndarray:
+        """Full packages per cell, as floats, 0 for unpackaged products.
+        Divisions truncate towards zero, as Decimal's `//` does; float
+        divisions are exact enough for that, and keep the sign of zeros."""
+        divisor = np.where(self.packaged, self.per_package, 1)
+        return np.where(self.packaged, np.trunc(self.quantity / divisor), 0.0)
+
+    # Per-row totals
+
+    @cached_property
+    def row_price(self) -> np.ndarray:
+        return self.cell_price.sum(axis=1)
+
+    @cached_property
+    def row_weight(self) -> np.ndarray:
+        return self.cell_weight.sum(axis=1)
+
+    @cached_property
+    def row_packages(self) -> np.ndarray:
+        return np.add.reduce(self.cell_packages, axis=1, initial=0.0)
+
+    @cached_property
+    def row_count(self) -> np.ndarray:
+        """Number of purchases in each row."""
+        return self.present.sum(axis=1)
+
+    # Per-product totals
+
+    @cached_property
+    def column_quantity(self) -> np.ndarray:
+        return self.quantity.sum(axis=0)
+
+    @cached_property
+    def column_price(self) -> np.ndarray:
+        return self.cell_price.sum(axis=0)
+
+    @cached_property
+    def column_weight(self) -> np.ndarray:
+        return self.cell_weight.sum(axis=0)
+
+    @cached_property
+    def column_packages(self) -> np.ndarray:
+        """Full packages per product, 0 for unpackaged products."""
+        divisor = np.where(self.packaged, self.per_package, 1)
+        return np.where(self.packaged, np.trunc(self.column_quantity / divisor), 0.0)
+
+    @cached_property
+    def column_out_of_package(self) -> np.ndarray:
+        return self.column_quantity - self.column_packages.astype(np.int64) * self.per_package
+
+    # Grand totals
+
+    @cached_property
+    def price(self) -> int:
+        return int(self.column_price.sum())
+
+    @cached_property
+    def weight(self) -> int:
+        return int(self.column_weight.sum())
+
+    @cached_property
+    def packages(self) -> float:
+        return float(np.add.reduce(self.column_packages, initial=0.0))
+
+    # Conversions back to Decimals / floats
+
+    def decimal_quantity(self, i: int, j: int) -> Decimal:
+        return _decimal(self.quantity[i, j], QUANTITY_SCALE)
+
+    @staticmethod
+    def to_decimal(n, what: str) -> Decimal:
+        """:param what: "quantity", "price" or "weight", which determines the scale."""
+        return _decimal(n, _SCALES[what])
+
+    @staticmethod
+    def to_float(n, what: str) -> float:
+        return _float(n, _SCALES[what])
+
+
+_SCALES = {
+    "quantity": QUANTITY_SCALE,
+    "price": QUANTITY_SCALE * PRICE_SCALE,
+    "weight": QUANTITY_SCALE * WEIGHT_SCALE,
+}
@@ -1,6 +1,6 @@
 """Excel spreadsheet views generator."""
 import re
-from io import BytesIO
+from tempfile import TemporaryFile
 import xlsxwriter as xls
 
 
@@ -33,18 +33,22 @@ H_CYCLE_LENGTH = 5
 
 BANNED_TITLE_CHARS = re.compile(r"[\[\]\*\?\\:/]+")
 
-def _make_sheet(book, title, fmt, buyers, products, purchases, purchase_fmls, recopy_products):
+def _make_sheet(book, title, fmt, dv_name, buyers, products, matrix, purchase_fmls, recopy_products):
     """
     Insert one sheet of (buyer, product) -> purchase matrix in an Excel book,
     with custom purchase values and formulae (Excel needs both). Optionally,
     an extra user line can be handled too.
 
+    Books are written in `constant_memory` mode: cells must be written row by row,
+    from top to bottom, since each row is flushed to disk as soon as the next one starts.
+
     :param book: where the sheet will be added
     :param title: name of the sheet
     :param fmt: dictionary of Excel formats
+    :param dv_name: delivery name, used as sheet header
     :param buyers: ordered list of buyers
     :param products: ordered list of products
-    :param purchases: function (buyer_idx, product_idx) -> quantity
+    :param matrix: `PurchaseMatrix` of (buyer_idx, product_idx) -> quantity
     :param purchase_fmls: Optional (user_index, pd_index) -> formula function
     """
     title = BANNED_TITLE_CHARS.sub("-", title)
@@ -56,63 +60,107 @@ def _make_sheet(book, title, fmt, buyers, products, purchases, purchase_fmls, re
         sheet.protect()
     sheet.set_column(0, 0, 30)
     sheet.set_column(1, 1, 12)
+    sheet.freeze_panes(ROW_OFFSET, COL_OFFSET)
+
+    n_products = len(products)
+    n_buyers = len(buyers)
+    # Totals are taken from the matrix rather than summed up cell by cell
+    price_buyer = [matrix.to_decimal(p, "price") for p in matrix.row_price]
+    qty_product = [matrix.to_decimal(q, "quantity") for q in matrix.column_quantity]
+    # Column names and row numbers used in formulae are Excel's, i.e. 1-based
+    col_names = [_col_name(c+COL_OFFSET) for c in range(n_products)]
+
+    # Row 1: title
     sheet.set_row(0, 75)
+    sheet.merge_range('A1:J1', dv_name, fmt['title'])
+
+    # Row 3: product names
     sheet.set_row(2, 50)
-    sheet.merge_range('A1:J1', products[0].delivery.name, fmt['title'])
-    sheet.freeze_panes(ROW_OFFSET, COL_OFFSET)
-    for row, title in enumerate(["Prix unitaire", "Poids unitaire", "Nombre par carton",
-                                 "Nombre de pièces", "Nombre de cartons", "Nombre en complément", "Prix total"]):
-        sheet.write('A%d'%(row+4), title, fmt['hdr_title_right'])
-    for r in range(3, 12):
-        sheet.write_blank(r, COL_OFFSET-1, None, fmt['hdr_blank'])
     sheet.write(2, COL_OFFSET-1, "Prix\n&\nTotaux", fmt['hdr_title'])
-
-    # Generate product names and prices rows on the first (possibly only) sheet
-    if not recopy_products:
-        # Product descriptions are written directly here, not taken from mainpage
-        for c, pd in enumerate(products):
-            # python row / Excel row: content
-            # 2/3: Name
-            # 3/4: Unit price
-            # 4/5: Unit weight
-            # 5/6: per package
-            # 6/7: number of units
-            # 7/8: number of packages
-            # 8/9: number loose units
-            # 9/10: total weight
-            # 10/11: total price (1 cell)
-            sheet.write(2, c+COL_OFFSET, _u8(pd.name), fmt['pd_name'])
-            sheet.write(3, c+COL_OFFSET, pd.price, fmt['hdr_price'])
-            sheet.write(4, c+COL_OFFSET, pd.unit_weight, fmt['hdr_weight'])
-            sheet.write(5, c+COL_OFFSET, pd.quantity_per_package or "-", fmt['hdr_qty'])
-    else:
+    if recopy_products:
         # In subgroup sheets, recopy product descriptions formulaicly from 1st page
-        for c, pd in enumerate(products):
-            fml = "=Commande!%(col)s%%s" % {'col': _col_name(c+COL_OFFSET)}
-            sheet.write(2, c+COL_OFFSET, fml % 3, fmt['pd_name'], _u8(pd.name))
-            sheet.write(3, c+COL_OFFSET, fml % 4, fmt['hdr_price'], pd.price)
-            sheet.write(4, c+COL_OFFSET, fml % 5, fmt['hdr_weight'], pd.unit_weight)
-            sheet.write(5, c+COL_OFFSET, fml % 6, fmt['hdr_qty'], pd.quantity_per_package)
+        fmls = ["=Commande!%s%%s" % colname for colname in col_names]
+    for c, pd in enumerate(products):
+        if recopy_products:
+            sheet.write(2, c+COL_OFFSET, fmls[c] % 3, fmt['pd_name'], _u8(pd.name))
+        else:
+            # Product descriptions are written directly here, not taken from mainpage
+            sheet.write(2, c+COL_OFFSET, _u8(pd.name), fmt['pd_name'])
 
-    n_products = len(products)
-    n_buyers = len(buyers)
-    price_buyer = [0] * n_buyers
-    weight_buyer = [0] * n_buyers
-    qty_buyer = [0] * n_buyers
-    qty_product = [0] * n_products
-    # weight_product = [0] * n_products
+    # Rows 4 to 10: product descriptions and totals
+    row_titles = ["Prix unitaire", "Poids unitaire", "Nombre par carton",
+                  "Nombre de pièces", "Nombre de cartons", "Nombre en complément", "Prix total"]
+    total_packages = 0
+    packaging = []  # (full, loose) per product
+    for pd, qty in zip(products, qty_product):
+        if pd.quantity_per_package:
+            (full, loose) = (qty // pd.quantity_per_package, qty % pd.quantity_per_package)
+            total_packages += full
+        else:
+            (full, loose) = ("-", "-")
+        packaging.append((full, loose))
+
+    for r, row_title in enumerate(row_titles, 3):
+        sheet.write(r, 0, row_title, fmt['hdr_title_right'])
+        if r == 7:  # Total # of packages
+            fml = "=SUM(%(firstcol)s8:%(lastcol)s8)" % \
+                  {'firstcol': _col_name(COL_OFFSET), 'lastcol': _col_name(n_products+COL_OFFSET-1)}
+            sheet.write(r, COL_OFFSET-1, fml, fmt['hdr_qty'], total_packages)
+        elif r == 9:  # Total price for all users
+            fml = "=SUM(%(sumcol)s%(firstrow)s:%(sumcol)s%(lastrow)s)" % \
+                  {'sumcol': _col_name(COL_OFFSET-1), 'firstrow': ROW_OFFSET+1, 'lastrow': n_buyers+ROW_OFFSET}
+            sheet.write(r, COL_OFFSET-1, fml, fmt['hdr_price'], matrix.to_decimal(matrix.price, "price"))
+        else:
+            sheet.write_blank(r, COL_OFFSET-1, None, fmt['hdr_blank'])
 
-    # Generate buyer names column.
+        for c, pd in enumerate(products):
+            vars = {'colname': col_names[c], 'firstrow': ROW_OFFSET+1, 'lastrow': n_buyers+ROW_OFFSET}
+            qty = qty_product[c]
+            full, loose = packaging[c]
+            if r == 3 and recopy_products:
+                sheet.write(r, c+COL_OFFSET, fmls[c] % 4, fmt['hdr_price'], pd.price)
+            elif r == 3:
+                sheet.write(r, c+COL_OFFSET, pd.price, fmt['hdr_price'])
+            elif r == 4 and recopy_products:
+                sheet.write(r, c+COL_OFFSET, fmls[c] % 5, fmt['hdr_weight'], pd.unit_weight)
+            elif r == 4:
+                sheet.write(r, c+COL_OFFSET, pd.unit_weight, fmt['hdr_weight'])
+            elif r == 5 and recopy_products:
+                sheet.write(r, c+COL_OFFSET, fmls[c] % 6, fmt['hdr_qty'], pd.quantity_per_package or "-")
+            elif r == 5:
+                sheet.write(r, c+COL_OFFSET, pd.quantity_per_package or "-", fmt['hdr_qty'])
+            elif r == 6:  # Quantity
+                fml = "=SUM(%(colname)s%(firstrow)s:%(colname)s%(lastrow)s)" % vars
+                sheet.write(r, c+COL_OFFSET, fml, fmt['hdr_qty'], qty)
+            elif r == 7:  # Packaged units
+                fml = "=IF(ISNUMBER(%(colname)s6), TRUNC(%(colname)s7 / %(colname)s6), \"-\")" % vars
+                sheet.write(r, c+COL_OFFSET, fml, fmt['hdr_qty'], full)
+            elif r == 8:  # Loose units
+                fml = "=IF(ISNUMBER(%(colname)s6), MOD(%(colname)s7, %(colname)s6), \"-\")" % vars
+                sheet.write(r, c+COL_OFFSET, fml, fmt['hdr_qty'], loose)
+            elif r == 9:  # Total price per product
+                fml = "=%(colname)s4*%(colname)s7" % vars
+                sheet.write(r, c+COL_OFFSET, fml, fmt['hdr_price'], pd.price*qty)
+
+    # Rows 11 and beyond: one per buyer, with name, total price and purchases
+    price_fml = "=SUMPRODUCT(" \
+                "%(firstcol)s$%(u_price_row)s:%(lastcol)s$%(u_price_row)s," \
+                "%(firstcol)s%%(qty_row)s:%(lastcol)s%%(qty_row)s)" % \
+                {'firstcol': _col_name(COL_OFFSET),
+                 'lastcol': _col_name(n_products+COL_OFFSET-1),
+                 'u_price_row': 4}  # unit price
+    quantities = matrix.quantity.tolist()
     for r, name in enumerate(buyers):
-        fmt_u = fmt['user_name_cycle'] if r % V_CYCLE_LENGTH == V_CYCLE_LENGTH-1 else fmt['user_name']
-        sheet.write(r+ROW_OFFSET, 0, _u8(name), fmt_u)
+        v_cycle = r % V_CYCLE_LENGTH == V_CYCLE_LENGTH-1
+        sheet.write(r+ROW_OFFSET, 0, _u8(name), fmt['user_name_cycle'] if v_cycle else fmt['user_name'])
 
-    # Fill purchases, count totals
-    for c, pd in enumerate(products):
-        h_cycle = c % H_CYCLE_LENGTH == H_CYCLE_LENGTH - 1
-        for r in range(n_buyers):
-            qty = purchases(r, c)
-            v_cycle = r % V_CYCLE_LENGTH == V_CYCLE_LENGTH-1
+        # Total price per buyer
+        fmt_p = fmt['hdr_user_price_cycle'] if v_cycle else fmt['hdr_user_price']
+        sheet.write(r+ROW_OFFSET, COL_OFFSET-1, price_fml % {'qty_row': r+ROW_OFFSET+1}, fmt_p, price_buyer[r])
+
+        for c, q in enumerate(quantities[r]):
+            qty = matrix.to_decimal(q, "quantity")
+            h_cycle = c % H_CYCLE_LENGTH == H_CYCLE_LENGTH - 1
             if h_cycle and v_cycle:  fmt_name = 'qty_vh_cycle'
             elif h_cycle:            fmt_name = 'qty_h_cycle'
             elif v_cycle:            fmt_name = 'qty_v_cycle'
@@ -123,25 +171,10 @@ def _make_sheet(book, title, fmt, buyers, products, purchases, purchase_fmls, re
                 sheet.write(r+ROW_OFFSET, c+COL_OFFSET, fml, fmt['f_'+fmt_name], qty)
             else:
                 sheet.write(r+ROW_OFFSET, c+COL_OFFSET, qty, fmt[fmt_name])
-            qty_buyer[r] += qty
-            qty_product[c] += qty
-            price_buyer[r] += qty * pd.price
-            # if pd.unit_weight:
-            #     w = qty * pd.unit_weight
-            #     weight_buyer[r] += w
-            #     weight_product[c] += w
-
-    # Total price per buyer
-    for r in range(n_buyers):
-        fml = "=SUMPRODUCT(" \
-              "%(firstcol)s$%(u_price_row)s:%(lastcol)s$%(u_price_row)s," \
-              "%(firstcol)s%(qty_row)s:%(lastcol)s%(qty_row)s)" % \
-              {'firstcol': _col_name(COL_OFFSET),
-               'lastcol': _col_name(n_products+COL_OFFSET-1),
-               'u_price_row': 4,  # unit price
-               'qty_row': r+ROW_OFFSET+1}
-        fmt_p = fmt['hdr_user_price_cycle'] if r % V_CYCLE_LENGTH == V_CYCLE_LENGTH-1 else fmt['hdr_user_price']
-        sheet.write(r+ROW_OFFSET, COL_OFFSET-1, fml, fmt_p, price_buyer[r])
+
+    # Header blanks overlapping the first buyer rows, when there are fewer than two buyers
+    for r in range(ROW_OFFSET + n_buyers, 12):
+        sheet.write_blank(r, COL_OFFSET-1, None, fmt['hdr_blank'])
 
     # TODO conditional formatting, make zero values less conspicious (light gray, smaller font...)
     # TODO https://xlsxwriter.readthedocs.io/working_with_conditional_formats.html
@@ -153,52 +186,6 @@ def _make_sheet(book, title, fmt, buyers, products, purchases, purchase_fmls, re
         'format': fmt['zero']
     })
 
-    # Total price for all users
-    fml = "=SUM(%%(sumcol)s%(firstrow)s:%%(sumcol)s%(lastrow)s)" % \
-          {'sumcol': _col_name(COL_OFFSET-1), 'firstrow':ROW_OFFSET+1, 'lastrow': n_buyers+ROW_OFFSET}
-    sheet.write(9, 1, fml % {'sumcol': 'B'}, fmt['hdr_price'], sum(price_buyer))
-
-    # Total quantities and weights per product
-    total_packages = 0
-    for c, pd in enumerate(products):
-        vars = {'colname': _col_name(c+COL_OFFSET), 'firstrow':ROW_OFFSET+1, 'lastrow': n_buyers+ROW_OFFSET}
-        qty = qty_product[c]
-
-        # Quantity
-        fml = "=SUM(%(colname)s%(firstrow)s:%(colname)s%(lastrow)s)" % vars
-        sheet.write(6, c+COL_OFFSET, fml, fmt['hdr_qty'], qty)
-
-        # Lose and packaged units
-        if pd.quantity_per_package:
-            (full, loose) = (qty // pd.quantity_per_package, qty % pd.quantity_per_package)
-            total_packages += full
-        else:
-            (full, loose) = ("-", "-")
-        fml = "=IF(ISNUMBER(%(colname)s6), TRUNC(%(colname)s7 / %(colname)s6), \"-\")" % vars
-        sheet.write(7, c+COL_OFFSET, fml, fmt['hdr_qty'], full)
-        fml = "=IF(ISNUMBER(%(colname)s6), MOD(%(colname)s7, %(colname)s6), \"-\")" % vars
-        sheet.write(8, c+COL_OFFSET, fml, fmt['hdr_qty'], loose)
-
-        # Weight
-        # fml = "=IF(ISNUMBER(%(colname)s5), %(colname)s7*%(colname)s5, \"?\")" % vars
-        # if pd.unit_weight:
-        #     weight = pd.unit_weight * qty
-        # else:
-        #     weight = "?"
-        # sheet.write(9, c+COL_OFFSET, fml, fmt['hdr_weight'], weight)
-        # sheet.write_blank(10, c+COL_OFFSET, None, fmt['hdr_blank'])
-
-        # Total price per product
-        fml = "=%(colname)s4*%(colname)s7" % vars
-        sheet.write(ROW_OFFSET-1, c+COL_OFFSET, fml, fmt['hdr_price'], pd.price*qty)
-
-    # Total # of packages and weight
-    vars = {'firstcol': _col_name(COL_OFFSET), 'lastcol': _col_name(n_products+COL_OFFSET-1)}
-    fml = "=SUM(%(firstcol)s8:%(lastcol)s8)" % vars
-    sheet.write(7, COL_OFFSET-1, fml, fmt['hdr_qty'], total_packages)
-    # fml = "=SUM(%(firstcol)s10:%(lastcol)s10)" % vars
-    # sheet.write(9, COL_OFFSET-1, fml, fmt['hdr_weight'], sum(weight_product))
-
 
 def _red(n):
     return "#"+''.join(('%02x'%(255-(255-x)//n) for x in (0x81, 0x13, 0x05)))
@@ -240,9 +227,12 @@ FORMATS = {
 
 def spreadsheet(dd):
     """Takes either a FlatDeliveryDescription or a GroupedDeliveryDescription.
-    GDD with only one network will be simplified into FDD."""
-    bytes_buffer = BytesIO()  # Generate in a string rather than a file
-    book = xls.Workbook(bytes_buffer, {'in_memory': True})
+    GDD with only one network will be simplified into FDD.
+
+    The book is written in an anonymous temporary file, one row at a time, so that memory
+    use doesn't grow with the delivery size; that file is returned, rewound, for streaming."""
+    xlsx_file = TemporaryFile()
+    book = xls.Workbook(xlsx_file, {'constant_memory': True})
     fmt = {k: book.add_format(v) for k, v in FORMATS.items()}
     # Everything but raw quantities is protected, i.e. everything with a style other than "qty_*"
     if PROTECT_FORMULA_CELLS:
@@ -258,30 +248,25 @@ def spreadsheet(dd):
         # There are several groups, they will have one page each, plus the recap
         group_descriptions = dd.subgroup_descriptions
         buyers = [sgd.subgroup.name for sgd in group_descriptions]
-        def purchases(sg_idx, pd_idx):
-            return dd.subgroup_descriptions[sg_idx].columns[pd_idx].quantity
-            # return x['table'][sg_idx]['totals'][pd_idx]['quantity']
         def purchase_fmls(sg_idx, pd_idx):
-            sg = dd.subgroup_descriptions[sg_idx].subgroup.name
+            sg = dd.subgroups[sg_idx].name
             col = _col_name(pd_idx + COL_OFFSET)
             return f"={sg}!{col}$7"
             # return "=%(subgroup)s!%(colname)s$7" % {
             #     'subgroup':x['table'][sg_idx]['subgroup'].name,
             #     'colname':_col_name(pd_idx+COL_OFFSET)}
 
-        _make_sheet(book, "Commande", fmt, buyers, dd.products, purchases, purchase_fmls,
+        _make_sheet(book, "Commande", fmt, dd.delivery.name, buyers, dd.products, dd.matrix, purchase_fmls,
                     recopy_products=False)
 
     # Each subgroup has its sheet
     for gd in group_descriptions:
         title = _u8(dd.delivery.name if single_group else gd.subgroup.name)
         buyers = [u.first_name + " " + u.last_name for u in gd.users]
-        def purchases(u_idx, pd_idx):
-            pc = gd.columns[pd_idx].purchases[u_idx]
-            return pc.quantity if pc is not None else 0
-        _make_sheet(book, title, fmt, buyers, gd.products, 
-                    purchases, purchase_fmls=None,
+        _make_sheet(book, title, fmt, dd.delivery.name, buyers, gd.products,
+                    gd.matrix, purchase_fmls=None,
                     recopy_products=not single_group)
 
     book.close()
-    return bytes_buffer.getvalue()
+    xlsx_file.seek(0)
+    return xlsx_file
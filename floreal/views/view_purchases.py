@@ -2,21 +2,29 @@
 
 import os
 from django.db.models import Q
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 
+import hashlib
 import json
+from datetime import timedelta
 from typing import List, Tuple, Dict, Set
 
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+
 from django.conf import settings
 from .getters import get_delivery, get_network, get_subgroup, must_be_staff, must_be_prod_or_staff
 from . import latex
 from .spreadsheet import spreadsheet
 from .delivery_description import FlatDeliveryDescription, GroupedDeliveryDescription, UserDeliveryDescription
+from .delivery_archive import archive_path, archive_response, iter_archive, write_archive
+from .json_stream import iter_json
 from .. import models as m
-from .latex import render_latex
+from .pdf_jobs import enqueue_pdf
 
 
 MIME_TYPE = {
@@ -25,58 +33,167 @@ MIME_TYPE = {
     'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
 
 
+# Delivery renderings: variant name -> (rendering function, file extension)
+RENDERERS = {
+    'json': (lambda dd: iter_json(dd.to_json(lazy=True)), 'json'),
+    'sparse': (lambda dd: iter_json(dd.to_json(lazy=True, sparse=True)), 'json'),
+    'xlsx': (spreadsheet, 'xlsx'),
+    'table': (latex.table, 'pdf'),
+    'cards': (latex.cards, 'pdf'),
+}
+
+
+def _attachment_name(name_stem, name_extension):
+    return (name_stem + "." + name_extension).replace(" ", "_")
+
+
 @login_required
 def non_html_response(request, name_stem, name_extension, content):
-    """Common helper to serve PDF and Excel content."""
+    """Common helper to serve PDF and Excel content.
+    `content` is either a string, a file to be streamed, or an iterator of strings to be streamed."""
     mime_type = MIME_TYPE[name_extension]
-    response = HttpResponse(content_type=mime_type)
+    if isinstance(content, (str, bytes)):
+        response = HttpResponse(content_type=mime_type)
+        response.write(content)
+    elif hasattr(content, 'read'):
+        response = FileResponse(content, content_type=mime_type)
+    else:
+        response = StreamingHttpResponse(content, content_type=mime_type)
     if name_stem is not None:
-        filename = (name_stem + "." + name_extension).replace(" ", "_")
+        filename = _attachment_name(name_stem, name_extension)
         response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-    response.write(content)
     return response
 
 
+def describe(dv, sg=None, empty_products=False, empty_users=False):
+    """Staff description of a delivery, restricted to subgroup `sg` if not None."""
+    if sg is not None:
+        return FlatDeliveryDescription(dv, subgroup=sg, empty_products=empty_products, empty_users=empty_users, values_only=True)
+    elif dv.network.grouped:
+        return GroupedDeliveryDescription(dv, empty_products=empty_products, empty_users=empty_users, values_only=True)
+    else:
+        return FlatDeliveryDescription(dv, empty_products=empty_products, empty_users=empty_users, values_only=True)
+
+
+def archive_delivery(dv) -> tuple:
+    """
+    Materialize the usual renderings of a terminated delivery in its archive,
+    for the whole network and for each of its subgroups.
+    PDFs are left to `manage.py pdf_worker`, which archives them once rendered.
+    Other variants will be archived the first time they're requested.
+    Return the numbers of files written and of PDFs queued.
+    """
+    subgroups = [None]
+    if dv.network.grouped:
+        subgroups += list(dv.network.networksubgroup_set.all())
+    written = queued = 0
+    for sg in subgroups:
+        dd = None
+        for variant, (renderer, extension) in RENDERERS.items():
+            path = archive_path(dv, variant, extension, sg)
+            if os.path.isfile(path):
+                continue
+            elif extension == 'pdf':
+                m.PdfJob.enqueue(_rendering_key(dv, variant, sg), 'delivery', _attachment_name(dv.name, extension),
+                                 variant=variant, delivery=dv.id, subgroup=sg.id if sg is not None else None,
+                                 empty_users=False, empty_products=False)
+                queued += 1
+            else:
+                if dd is None:
+                    dd = describe(dv, sg)
+                write_archive(path, renderer(dd))
+                written += 1
+    return written, queued
+
+
+def _rendering_key(dv, variant, sg=None, empty_users=False, empty_products=False):
+    # Every change in what descriptions show bumps the delivery generation (cf. `signals.handlers`):
+    # it tells, without any additional query, whether the client's copy is still up-to-date.
+    return "%s:dv-%d:g%d:sg-%s:%d%d" % (
+        variant, dv.id, dv.generation, sg.id if sg is not None else "", empty_users, empty_products)
+
+
+def _get_viewer_subgroup(request, dv, subgroup=None):
+    """
+    Check that the requesting user can view the purchases of delivery `dv`.
+    :return: the subgroup whose purchases are viewed, None for the whole network.
+    """
+    try:
+        must_be_prod_or_staff(request, dv.network)
+    except PermissionDenied as e:
+        # Try to restrict to subgroup if user is subgroup staff
+        sg = m.NetworkSubgroup.objects.filter(
+            networkmembership__valid_until=None,
+            networkmembership__user_id = request.user.id,
+            networkmembership__is_subgroup_staff=True,
+            network__id=dv.network_id,
+        ).first()
+        if sg is None:
+            raise
+        return sg
+    return get_subgroup(subgroup) if subgroup is not None else None
+
+
 @login_required
-def render_description(request, delivery, renderer, extension, subgroup=None, user: bool=False, download=True):
+def render_description(request, delivery, variant, subgroup=None, user: bool=False, download=True):
     """
     Retrieve the delivery description associated with those url params if permissions allow.
     """
     # TODO test memberships based on distribution date, not on current memberships
+    renderer, extension = RENDERERS[variant]
     dv = get_delivery(delivery)
     if not user:
-        try:
-            must_be_prod_or_staff(request, dv.network)
-            sg = None
-        except PermissionDenied as e:
-            # Try to restrict to subgroup if user is subgroup staff
-            sg = m.NetworkSubgroup.objects.filter(
-                networkmembership__valid_until=None,
-                networkmembership__user_id = request.user.id,
-                networkmembership__is_subgroup_staff=True,
-                network__id=dv.network_id,
-            ).first()
-            if sg is None:
-                raise
+        sg = _get_viewer_subgroup(request, dv, subgroup)
 
     empty_products = request.GET.get('empty_products', '0') == '1'
     empty_users = request.GET.get('empty_users', '0') == '1'
+    name_stem = dv.name if download else None
+
+    rendering_key = _rendering_key(dv, variant, sg if not user else None, empty_users, empty_products)
+    if user:
+        rendering_key += ":u-%d" % request.user.id
+    etag = '"%s"' % rendering_key
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
 
     if user:
         dd = UserDeliveryDescription(dv, request.user, empty_products=True)
-    elif subgroup is not None or sg is not None:
-        if sg is None:
-            sg = get_subgroup(subgroup)
-        dd = FlatDeliveryDescription(dv, subgroup=sg, empty_products=empty_products, empty_users=empty_users)
-    elif dv.network.grouped:
-        dd = GroupedDeliveryDescription(dv, empty_products=empty_products, empty_users=empty_users)
+        response = non_html_response(request, name_stem, extension, json.dumps(dd.to_json()))
+
+    # Terminated deliveries are rendered once and for all, then served from the archive.
+    # Their PDFs are archived by the PDF worker, like any other PDF they're never rendered here.
+    elif dv.state == m.Delivery.TERMINATED and (
+            extension != 'pdf' or os.path.isfile(archive_path(dv, variant, extension, sg, empty_users, empty_products))):
+        path = archive_path(dv, variant, extension, sg, empty_users, empty_products)
+        if not os.path.isfile(path):
+            write_archive(path, renderer(describe(dv, sg, empty_products, empty_users)))
+        filename = _attachment_name(name_stem, extension) if name_stem is not None else None
+        response = archive_response(path, MIME_TYPE[extension], filename)
+
+    # LaTeX is run by `manage.py pdf_worker`, the client is redirected to a page waiting for it
+    elif extension == 'pdf':
+        return enqueue_pdf(request, rendering_key, 'delivery', dv.name, variant=variant, delivery=dv.id,
+                           subgroup=sg.id if sg is not None else None,
+                           empty_users=empty_users, empty_products=empty_products)
+
+    # Staff JSON descriptions are requested over and over by the purchase tables,
+    # cache them as long as the delivery's generation doesn't change.
+    elif extension == 'json':
+        path = archive_path(dv, variant, extension, sg, empty_users, empty_products, live=True)
+        if os.path.isfile(path):
+            response = archive_response(path, MIME_TYPE[extension])
+        else:
+            chunks = iter_archive(path, renderer(describe(dv, sg, empty_products, empty_users)))
+            response = non_html_response(request, None, extension, chunks)
+
     else:
-        dd = FlatDeliveryDescription(dv, empty_products=empty_products, empty_users=empty_users)
+        response = non_html_response(request, name_stem, extension, renderer(describe(dv, sg, empty_products, empty_users)))
 
-    name_stem = dd.delivery.name if download else None
-    #if not isinstance(dd, UserDeliveryDescription) and not (dd.rows and dd.products):
-    #    return HttpResponse("Aucun achat dans cette commande", status=404)
-    return non_html_response(request, name_stem, extension, renderer(dd))
+    # Let browsers keep their copy, provided they check that it's still up-to-date
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required
@@ -97,8 +214,7 @@ def view_purchases_xlsx(request, delivery, subgroup=None):
     (subgroup) staff only."""
     m.JournalEntry.log(request.user, "Downloaded Excel purchases for dv-%s", delivery)
     return render_description(
-        request=request, delivery=delivery, subgroup=subgroup,
-        renderer=spreadsheet, extension='xlsx'
+        request=request, delivery=delivery, subgroup=subgroup, variant='xlsx'
     )
 
 
@@ -107,8 +223,7 @@ def view_purchases_latex_table(request, delivery, subgroup=None):
     (subgroup) staff only."""
     m.JournalEntry.log(request.user, "Downloaded PDF purchases for dv-%s", delivery)
     return render_description(
-        request=request, delivery=delivery, subgroup=subgroup,
-        renderer=latex.table, extension='pdf'
+        request=request, delivery=delivery, subgroup=subgroup, variant='table'
     )
 
 def view_purchases_latex_cards(request, delivery, subgroup=None):
@@ -116,24 +231,85 @@ def view_purchases_latex_cards(request, delivery, subgroup=None):
     (subgroup) staff only."""
     m.JournalEntry.log(request.user, "Downloaded PDF purchases (cards) for dv-%s", delivery)
     return render_description(
-        request=request, delivery=delivery, subgroup=subgroup,
-        renderer=latex.cards, extension='pdf'
+        request=request, delivery=delivery, subgroup=subgroup, variant='cards'
     )
 
 
 def view_purchases_json(request, delivery, subgroup=None, user: bool = False):
-    return render_description(
+    """With `?format=sparse`, purchases are sent as `[row, column, quantity]` triples
+    rather than as a dense array, cf. `FlatDeliveryDescription.to_json()`.
+
+    The `X-Watermark` header can be passed back as `?since=<watermark>`, to only
+    retrieve the purchases changed since then, cf. `purchases_since()`."""
+    if 'since' in request.GET and not user:
+        return purchases_since(request, delivery, subgroup)
+    watermark = timezone.now()
+    variant = 'sparse' if request.GET.get('format') == 'sparse' else 'json'
+    response = render_description(
         download=False,
-        request=request, delivery=delivery, user=user, subgroup=subgroup,
-        renderer=lambda dd: json.dumps(dd.to_json()), extension='json'
+        request=request, delivery=delivery, user=user, subgroup=subgroup, variant=variant
     )
+    if not user:
+        response['X-Watermark'] = watermark.isoformat()
+    return response
 
 
-def all_deliveries(request, network, states):
+# Transactions might commit changes timestamped slightly before the watermark
+# of a concurrent request: changes slightly older than the watermark are sent again.
+WATERMARK_OVERLAP = timedelta(seconds=5)
+
+
+@login_required
+def purchases_since(request, delivery, subgroup=None):
+    """
+    Purchases modified, created or deleted since `?since=<watermark>`, as a
+    `{"watermark": w, "purchases": [[user_id, product_id, quantity]...], "deleted": [[user_id, product_id]...]}`
+    object, where `w` is the watermark to pass for the next changes. Some changes might be sent more than once.
 
+    Responds 410 Gone when tombstones of deletions since then might have been purged:
+    the whole description must be retrieved again.
+    """
+    dv = get_delivery(delivery)
+    sg = _get_viewer_subgroup(request, dv, subgroup)
+    watermark = timezone.now()
+    try:
+        since = parse_datetime(request.GET['since'])
+    except ValueError:
+        since = None
+    if since is None:
+        return HttpResponseBadRequest("Date invalide")
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    since -= WATERMARK_OVERLAP
+    if since < watermark - m.PurchaseDeletion.RETENTION:
+        return HttpResponse("Trop ancien, recharger toute la commande", status=410)
+
+    purchases = m.Purchase.objects.filter(product__delivery=dv, modified__gte=since)
+    deletions = m.PurchaseDeletion.objects.filter(delivery_id=dv.id, deleted__gte=since)
+    if sg is not None:
+        members = m.NetworkMembership.objects.filter(subgroup=sg, valid_until=None).values("user_id")
+        purchases = purchases.filter(user_id__in=members)
+        deletions = deletions.filter(user_id__in=members)
+    purchases = [[u_id, pd_id, float(q)] for u_id, pd_id, q in purchases.values_list("user_id", "product_id", "quantity")]
+    # Purchases re-created since their deletion aren't deleted anymore
+    existing = {(u_id, pd_id) for u_id, pd_id, _ in purchases}
+    deleted = {(u_id, pd_id) for u_id, pd_id in deletions.values_list("user_id", "product_id")} - existing
+
+    return JsonResponse({
+        "watermark": watermark.isoformat(),
+        "purchases": purchases,
+        "deleted": list(deleted),
+    })
+
+
+def all_deliveries(request, network, states):
     nw = get_network(network)
     must_be_prod_or_staff(request, nw)
+    return all_deliveries_context(nw, states)
+
 
+def all_deliveries_context(nw, states):
+    """Which users ordered in which deliveries of network `nw`, among those in `states`."""
     purchases = (m.Purchase.objects.filter(
             product__delivery__state__in=states,
             product__delivery__network=nw)
@@ -168,6 +344,10 @@ def all_deliveries_html(request, network, states):
 
 
 def all_deliveries_latex(request, network, states):
-    ctx = all_deliveries(request, network, states)
-    content = render_latex("all_deliveries.tex", ctx)
-    return non_html_response(request, get_network(network).name, "pdf", content)
+    nw = get_network(network)
+    must_be_prod_or_staff(request, nw)
+    # Purchase changes bump their delivery's generation, state changes alter the set of deliveries
+    versions = m.Delivery.objects.filter(network=nw, state__in=states).order_by("id").values_list("id", "generation")
+    key = "all_deliveries:nw-%d:%s:%s" % (
+        nw.id, states, hashlib.sha1(repr(list(versions)).encode()).hexdigest())
+    return enqueue_pdf(request, key, 'all_deliveries', nw.name, network=nw.id, states=states)
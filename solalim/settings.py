@@ -48,6 +48,25 @@ REQUIRE_UNIQUE_EMAIL = False
 
 # Application definitions
 DELIVERY_ARCHIVE_DIR = os.path.join(BASE_DIR, "delivery_archive")
+# Internal nginx location aliased to DELIVERY_ARCHIVE_DIR, used to serve archived files
+# through `X-Accel-Redirect`. When None, Django serves them itself.
+DELIVERY_ARCHIVE_URL = None if DEBUG else "/delivery_archive/"
+# JSON descriptions of ongoing deliveries, versioned by `Delivery.generation`.
+# Under the archive directory, so that nginx serves them too.
+DELIVERY_DESCRIPTION_CACHE_DIR = os.path.join(DELIVERY_ARCHIVE_DIR, "live")
+# PDFs rendered by `manage.py pdf_worker`. Under the archive directory, so that nginx serves them too.
+PDF_JOB_DIR = os.path.join(DELIVERY_ARCHIVE_DIR, "pdf-jobs")
+# How many PDFs `manage.py pdf_worker` renders simultaneously, unless overridden by `--workers`
+PDF_WORKERS = 2
+# PDFs compiled by LaTeX, indexed by their TeX source; least recently used ones are evicted
+# when the cache grows beyond `LATEX_CACHE_SIZE` bytes. A docker volume of its own, kept across
+# deployments and shared by the PDF workers, but not served by nginx.
+LATEX_CACHE_DIR = os.path.join(BASE_DIR, "latex_cache")
+LATEX_CACHE_SIZE = 200 * 1024 * 1024
+# LaTeX formats where the preamble of `common.tex` is precompiled
+LATEX_FORMAT_DIR = os.path.join(LATEX_CACHE_DIR, "formats")
+# `.aux` files of the last compilation of each document, to converge faster the next time
+LATEX_AUX_DIR = os.path.join(LATEX_CACHE_DIR, "aux")
 
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 5000
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5000000
@@ -60,6 +79,8 @@ IMPERSONATE = {
 
 if not os.path.isdir(DELIVERY_ARCHIVE_DIR):
     os.makedirs(DELIVERY_ARCHIVE_DIR)
+if not os.path.isdir(PDF_JOB_DIR):
+    os.makedirs(PDF_JOB_DIR)
 
 
 INSTALLED_APPS = (
@@ -194,22 +215,32 @@ WAGTAILSEARCH_BACKENDS = {
     }
 }
 
-if False:
-    # Enables real-time SQL logs
-    LOGGING = {
-        'version': 1,
-        'disable_existing_loggers': False,
-        'handlers': {
-            'console': {
-                'level': 'DEBUG',
-                'class': 'logging.StreamHandler',
-            },
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'level': 'DEBUG',
+            'class': 'logging.StreamHandler',
         },
-        'loggers': {
-            'django.db.backends': {
-                'handlers': ['console'],
-                'level': 'DEBUG',
-                'propagate': True,
-            },
+    },
+    'loggers': {
+        # PDF renderings: jobs, failures, pdflatex passes per document
+        'floreal.views.latex': {
+            'handlers': ['console'],
+            'level': 'INFO',
         },
+        'floreal.views.pdf_jobs': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+if False:
+    # Enables real-time SQL logs
+    LOGGING['loggers']['django.db.backends'] = {
+        'handlers': ['console'],
+        'level': 'DEBUG',
+        'propagate': True,
     }